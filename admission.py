@@ -0,0 +1,137 @@
+import time
+import logging
+
+import relay
+
+logger = logging.getLogger('zzapp')
+
+# Per-IP rate buckets kept before full (idle) ones are pruned.
+MAX_TRACKED = 65536
+
+GLOBAL = 'global'
+PER_IP = 'per_ip'
+RATE = 'rate'
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`. The balance may go negative (debt)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n):
+        """Spend `n` tokens, returns how many seconds the caller is ahead of the rate (0 when within it)."""
+        self.refill(time.monotonic())
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_take(self):
+        """Spend one token if there is one."""
+        self.refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Admission:
+    """
+    Connection admission control shared by the SOCKS5 and HTTP proxies: a global cap on open
+    client connections, a per-source-IP cap and connection rate (token bucket), and the
+    handshake/auth/idle deadlines and per-connection bandwidth the proxies apply.
+    0 disables a limit.
+    """
+
+    def __init__(self, max_connections=0, max_per_ip=0, ip_rate=0.0, ip_burst=0, handshake_timeout=10.0,
+                 auth_timeout=10.0, idle_timeout=0.0, bandwidth=0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst or max(1, int(ip_rate))
+        self.handshake_timeout = handshake_timeout or None
+        self.auth_timeout = auth_timeout or None
+        self.idle_timeout = idle_timeout
+        self.bandwidth = bandwidth
+
+        self.active = 0
+        self._per_ip = {}  # ip -> open connections
+        self._buckets = {}  # ip -> TokenBucket
+
+        self.admitted = 0
+        self.rejected = {GLOBAL: 0, PER_IP: 0, RATE: 0}
+        self.handshake_timeouts = 0
+        self.auth_timeouts = 0
+        self.idle_timeouts = 0
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'admitted': self.admitted,
+            'rejected_global': self.rejected[GLOBAL],
+            'rejected_per_ip': self.rejected[PER_IP],
+            'rejected_rate': self.rejected[RATE],
+            'handshake_timeouts': self.handshake_timeouts,
+            'auth_timeouts': self.auth_timeouts,
+            'idle_timeouts': self.idle_timeouts,
+        }
+
+    def admit(self, ip):
+        """
+        Account a new connection from `ip`. Returns None when it is admitted (call release() when
+        it closes), otherwise the limit that rejected it: GLOBAL, PER_IP or RATE.
+        """
+        if self.max_connections and self.active >= self.max_connections:
+            reason = GLOBAL
+        elif self.max_per_ip and self._per_ip.get(ip, 0) >= self.max_per_ip:
+            reason = PER_IP
+        elif self.ip_rate and not self._bucket(ip).try_take():
+            reason = RATE
+        else:
+            self.active += 1
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            self.admitted += 1
+            return None
+        self.rejected[reason] += 1
+        return reason
+
+    def release(self, ip):
+        self.active -= 1
+        n = self._per_ip[ip] - 1
+        if n:
+            self._per_ip[ip] = n
+        else:
+            del self._per_ip[ip]
+
+    def shaper(self):
+        """Bandwidth bucket for one direction of a tunnel, None when shaping is off."""
+        if not self.bandwidth:
+            return None
+        # One relay buffer of burst, so a full read never has to wait on its own.
+        return TokenBucket(self.bandwidth, max(self.bandwidth, relay.BUFFER_SIZE))
+
+    def _bucket(self, ip):
+        bucket = self._buckets.get(ip)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED:
+                self._prune()
+            bucket = self._buckets[ip] = TokenBucket(self.ip_rate, self.ip_burst)
+        return bucket
+
+    def _prune(self):
+        # A bucket that has refilled completely behaves exactly like a new one, so it can be dropped.
+        now = time.monotonic()
+        for ip in list(self._buckets):
+            bucket = self._buckets[ip]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[ip]
+        if len(self._buckets) >= MAX_TRACKED:
+            logger.warning("Tracking %s client IPs for rate limiting, dropping all buckets.", len(self._buckets))
+            self._buckets.clear()
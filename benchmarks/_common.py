@@ -0,0 +1,26 @@
+"""Helpers shared by the benchmark scripts, which import it from their own directory."""
+
+import time
+import socket
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on {port}")
+
+
+def percentile(values, p):
+    """`values` sorted ascending."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
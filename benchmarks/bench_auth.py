@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+SOCKS5 username/password handshakes per second against an --htpasswd file.
+
+    python3 benchmarks/bench_auth.py --users 10000 --duration 10
+
+Writes an htpasswd file with --users pbkdf2-sha256 users, starts socks5.py on
+it and runs clients that each log in as a random user and hang up, once with
+the verified-credentials cache disabled and once with it enabled. Generating
+the file costs --rounds PBKDF2 rounds per user, keep them low for large files.
+The cached run logs every --hot user in once before measuring.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+from _common import free_port, wait_listening, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import credentials  # noqa: E402
+
+
+def user_line(args):
+    n, rounds = args
+    return f"user{n}:{credentials.hash_password(f'password{n}', rounds)}\n"
+
+
+def write_htpasswd(path, users, rounds):
+    with multiprocessing.Pool() as pool, open(path, 'w') as f:
+        f.writelines(pool.imap(user_line, ((n, rounds) for n in range(users)), chunksize=256))
+
+
+async def login(port, n):
+    user, password = f"user{n}".encode(), f"password{n}".encode()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(b'\x05\x01\x02')
+        await reader.readexactly(2)
+        writer.write(b'\x01' + bytes([len(user)]) + user + bytes([len(password)]) + password)
+        status = await reader.readexactly(2)
+        if status[1] != 0:
+            raise OSError("auth failed")
+    finally:
+        writer.close()
+
+
+async def client(port, users, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            await login(port, random.randrange(users))
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError):
+            errors.append(1)
+
+
+async def warm_up(port, users, connections):
+    for first in range(0, users, connections):
+        await asyncio.gather(*(login(port, n) for n in range(first, min(users, first + connections))))
+
+
+def scenario(name, path, cache_ttl, args):
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, 'socks5.py'), '-P', str(port), '--htpasswd', path,
+               '--auth-cache-ttl', str(cache_ttl), '--auth-threads', str(args.threads), '--log-queue', '10000']
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(port, 60)
+
+        # --hot users log in over and over, the rest of the file is only there to be searched.
+        users = min(args.hot, args.users) if args.hot else args.users
+
+        async def run():
+            if cache_ttl:
+                await warm_up(port, users, args.connections)
+            latencies, errors = [], []
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(*(client(port, users, deadline, latencies, errors)
+                                   for _ in range(args.connections)))
+            return sorted(latencies), len(errors)
+
+        latencies, errors = asyncio.run(run())
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    if not latencies:
+        print(f"{name:8} no successful handshakes, errors={errors}")
+        return
+    print(f"{name:8} {len(latencies) / args.duration:8.0f} handshakes/s errors={errors} "
+          f"p50={percentile(latencies, 50) * 1000:.2f}ms p99={percentile(latencies, 99) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SOCKS5 authentication benchmark')
+    parser.add_argument('--users', type=int, default=10000, help="Users in the htpasswd file [default: 10000]")
+    parser.add_argument('--hot', type=int, default=500,
+                        help="Log in only as the first N users, 0 for all of them [default: 500]")
+    parser.add_argument('--rounds', type=int, default=credentials.PBKDF2_ROUNDS,
+                        help=f"PBKDF2 rounds per user [default: {credentials.PBKDF2_ROUNDS}]")
+    parser.add_argument('--connections', type=int, default=32, help="Concurrent clients [default: 32]")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per run [default: 10]")
+    parser.add_argument('--threads', type=int, default=4, help="socks5.py --auth-threads [default: 4]")
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(prefix='bench_auth_', suffix='.htpasswd')
+    os.close(fd)
+    try:
+        started = time.monotonic()
+        write_htpasswd(path, args.users, args.rounds)
+        print(f"{args.users} users, {args.rounds} rounds, written in {time.monotonic() - started:.1f}s")
+        scenario('no cache', path, 0, args)
+        scenario('cache', path, 300, args)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
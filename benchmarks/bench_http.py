@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Plain HTTP load through httproxy.py against a local origin server.
+
+    python3 benchmarks/bench_http.py --connections 64 --duration 10
+
+Every client connection is keep-alive (unless --close) and sends GETs back
+to back, the report shows requests/s and the latency percentiles. Compare
+with --no-pool to see the effect of the upstream keep-alive pool.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+from _common import free_port, wait_listening, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def origin(port, body_size):
+    body = b'x' * body_size
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                writer.write(response)
+                await writer.drain()
+                if b'Connection: close' in head:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+async def client(proxy_port, url, close, deadline, latencies, errors):
+    connection = "Connection: close\r\n" if close else ""
+    request = f"GET {url} HTTP/1.1\r\nHost: 127.0.0.1\r\n{connection}\r\n".encode()
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if b'Connection: close' in head:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError):
+            errors.append(1)
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run(args, proxy_port, url):
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(client(proxy_port, url, args.close, deadline, latencies, errors)
+                           for _ in range(args.connections)))
+    return sorted(latencies), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP proxy load benchmark')
+    parser.add_argument('--connections', type=int, default=64, help="Concurrent client connections [default: 64]")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run [default: 10]")
+    parser.add_argument('--body-size', type=int, default=1024, help="Origin response body bytes [default: 1024]")
+    parser.add_argument('--workers', type=int, default=1, help="httproxy.py --workers [default: 1]")
+    parser.add_argument('--no-pool', action='store_true', help="Disable the upstream keep-alive pool")
+    parser.add_argument('--close', action='store_true', help="Clients send Connection: close on every request")
+    args = parser.parse_args()
+
+    origin_port = free_port()
+    origin_process = multiprocessing.Process(target=origin, args=(origin_port, args.body_size), daemon=True)
+    origin_process.start()
+
+    proxy_port = free_port()
+    command = [sys.executable, os.path.join(ROOT, 'httproxy.py'), '-P', str(proxy_port), '-w', str(args.workers)]
+    if args.no_pool:
+        command += ['--pool-max-idle', '0']
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(origin_port)
+        wait_listening(proxy_port)
+        latencies, errors = asyncio.run(run(args, proxy_port, f"http://127.0.0.1:{origin_port}/"))
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        origin_process.terminate()
+
+    if not latencies:
+        print(f"No successful requests, errors={errors}")
+        return
+    print(f"requests={len(latencies)} errors={errors}")
+    print(f"{len(latencies) / args.duration:10.0f} req/s")
+    for p in (50, 90, 99):
+        print(f"p{p:<3} {percentile(latencies, p) * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
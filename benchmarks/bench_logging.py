@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Event-loop lag caused by logging, direct handler vs --log-queue.
+
+    python3 benchmarks/bench_logging.py --rate 2000 --duration 5
+
+A ticker task sleeps `--tick` ms in a loop and records how late it wakes up
+while other tasks log `--rate` records/s to a file. With --fsync every record
+is flushed to disk, standing in for a slow or contended log volume. Each mode
+runs in its own process so handlers and listener threads do not mix.
+"""
+
+import os
+import sys
+import asyncio
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+from _common import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import util  # noqa: E402
+
+
+class FsyncFileHandler(logging.FileHandler):
+    def flush(self):
+        super().flush()
+        if self.stream:
+            os.fsync(self.stream.fileno())
+
+
+async def ticker(tick, deadline, lags):
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        start = loop.time()
+        await asyncio.sleep(tick)
+        lags.append(loop.time() - start - tick)
+
+
+async def load(logger, rate, deadline, tasks):
+    loop = asyncio.get_running_loop()
+    interval = tasks / rate
+    n = 0
+    while loop.time() < deadline:
+        logger.info("[%s] CONNECT request to %s:%s", ('127.0.0.1', 40000 + n % 20000), 'example.com', 443)
+        n += 1
+        await asyncio.sleep(interval)
+
+
+def measure(mode, args, filename, results):
+    handler = FsyncFileHandler(filename) if args.fsync else logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s[%(process)d] [%(levelname)s] %(message)s"))
+    if mode == 'queue':
+        handler = util.QueueLogHandler(handler, args.queue_size)
+    logger = logging.getLogger('zzapp')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    async def run():
+        lags = []
+        deadline = asyncio.get_running_loop().time() + args.duration
+        await asyncio.gather(ticker(args.tick / 1000, deadline, lags),
+                             *(load(logger, args.rate, deadline, args.tasks) for _ in range(args.tasks)))
+        return sorted(lags)
+
+    lags = asyncio.run(run())
+    dropped = getattr(handler, 'dropped', 0)
+    logging.shutdown()
+    results.put((lags, dropped))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging event-loop lag benchmark')
+    parser.add_argument('--rate', type=int, default=2000, help="Log records per second [default: 2000]")
+    parser.add_argument('--duration', type=float, default=5, help="Seconds per mode [default: 5]")
+    parser.add_argument('--tasks', type=int, default=16, help="Concurrent logging tasks [default: 16]")
+    parser.add_argument('--tick', type=float, default=1, help="Ticker interval in ms [default: 1]")
+    parser.add_argument('--queue-size', type=int, default=10000, help="--log-queue size [default: 10000]")
+    parser.add_argument('--fsync', action='store_true', help="fsync after every record")
+    args = parser.parse_args()
+
+    for mode in ('direct', 'queue'):
+        fd, filename = tempfile.mkstemp(prefix='bench_logging_', suffix='.log')
+        os.close(fd)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(mode, args, filename, results))
+        process.start()
+        lags, dropped = results.get()
+        process.join()
+        with open(filename, 'rb') as f:
+            written = sum(1 for _ in f)
+        os.unlink(filename)
+
+        print(f"{mode:6} written={written} dropped={dropped} "
+              f"p50={percentile(lags, 50) * 1000:.3f}ms p99={percentile(lags, 99) * 1000:.3f}ms "
+              f"max={lags[-1] * 1000:.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Loopback throughput of the tunnel relay engines.
+
+    python3 benchmarks/bench_relay.py --size 512 --engines stream sock splice
+
+A blocking source thread pushes --size MiB through Socks5Proxy.pipe_bi into a
+blocking sink thread, so the event loop only carries the relay itself.
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import relay  # noqa: E402
+from socks5 import Socks5Proxy  # noqa: E402
+
+CHUNK = 1 << 16
+
+
+def sink(listener, result):
+    conn, _ = listener.accept()
+    total = 0
+    buf = bytearray(1 << 20)
+    with conn:
+        while True:
+            n = conn.recv_into(buf)
+            if not n:
+                break
+            total += n
+    result['bytes'] = total
+    result['end'] = time.perf_counter()
+
+
+def source(port, size, result):
+    payload = memoryview(os.urandom(CHUNK))
+    with socket.create_connection(('127.0.0.1', port)) as conn:
+        result['start'] = time.perf_counter()
+        sent = 0
+        while sent < size:
+            conn.sendall(payload)
+            sent += CHUNK
+        conn.shutdown(socket.SHUT_WR)
+        # Wait for the relay to close us, otherwise the tail of the data may be cut off.
+        conn.recv(1)
+
+
+async def run_engine(engine, size):
+    listener = socket.create_server(('127.0.0.1', 0))
+    sink_port = listener.getsockname()[1]
+    result = {}
+    sink_thread = threading.Thread(target=sink, args=(listener, result), daemon=True)
+    sink_thread.start()
+
+    async def handle(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', sink_port)
+        await Socks5Proxy.pipe_bi(reader, writer, upstream_reader, upstream_writer, engine)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        await asyncio.to_thread(source, port, size, result)
+        await asyncio.to_thread(sink_thread.join)
+    listener.close()
+
+    elapsed = result['end'] - result['start']
+    return result['bytes'], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Relay engine throughput benchmark')
+    parser.add_argument('--size', type=int, default=512, help="MiB to push per run [default: 512]")
+    parser.add_argument('--runs', type=int, default=3, help="Runs per engine [default: 3]")
+    parser.add_argument('--engines', nargs='+', default=['stream', 'sock', 'splice'], choices=relay.ENGINES)
+    args = parser.parse_args()
+
+    size = args.size << 20
+    for engine in args.engines:
+        if engine == 'splice' and not relay.HAS_SPLICE:
+            print(f"{engine:>8}: not available on this platform")
+            continue
+        best = 0.0
+        for _ in range(args.runs):
+            received, elapsed = asyncio.run(run_engine(engine, size))
+            if received != size:
+                print(f"{engine:>8}: short transfer {received}/{size} bytes")
+            best = max(best, received * 8 / elapsed / 1e6)
+        print(f"{engine:>8}: {best:10.1f} Mbit/s (best of {args.runs})")
+
+
+if __name__ == '__main__':
+    main()
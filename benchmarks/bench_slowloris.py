@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Slowloris-style flood against socks5.py while legitimate clients keep tunnelling.
+
+    python3 benchmarks/bench_slowloris.py --attackers 1500 --duration 15
+
+Attackers connect from 127.0.0.2 and send the SOCKS5 greeting one byte at a
+time, reconnecting whenever the proxy drops them. Legitimate clients connect
+from 127.0.0.1, do a full handshake and an echo round trip through a local
+origin. The proxy runs with a limited file descriptor budget (--proxy-fds), once
+with the given --proxy-args and once with the handshake deadline disabled,
+and the report shows how many legitimate tunnels succeeded and their latency.
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import resource
+import subprocess
+import multiprocessing
+
+from _common import free_port, wait_listening, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PROXY_ARGS = '--handshake-timeout 2 --max-per-ip 256'
+
+
+def origin(port):
+    async def handle(reader, writer):
+        try:
+            while data := await reader.read(4096):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def attack(proxy_port, attackers, interval, duration):
+    async def slow_client(deadline):
+        greeting = b'\x05\x01\x00'
+        while time.monotonic() < deadline:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port, local_addr=('127.0.0.2', 0))
+                # Never finish the greeting, just keep the connection busy.
+                sent = 0
+                while time.monotonic() < deadline:
+                    writer.write(greeting[sent % 2:sent % 2 + 1])
+                    sent += 1
+                    await writer.drain()
+                    try:
+                        await asyncio.wait_for(reader.read(1), interval)
+                    except asyncio.TimeoutError:
+                        continue
+                    if reader.at_eof():
+                        break
+            except OSError:
+                pass
+            finally:
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(interval)
+
+    async def run():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(slow_client(deadline) for _ in range(attackers)))
+
+    asyncio.run(run())
+
+
+async def legit_client(proxy_port, origin_port, deadline, latencies, errors):
+    request = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', origin_port)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        writer = None
+        try:
+            async with asyncio.timeout(5):
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                writer.write(b'\x05\x01\x00')
+                await reader.readexactly(2)
+                writer.write(request)
+                reply = await reader.readexactly(10)
+                if reply[1] != 0:
+                    raise OSError(f"REP {reply[1]}")
+                writer.write(b'ping')
+                await reader.readexactly(4)
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError, TimeoutError):
+            errors.append(1)
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(0.05)
+
+
+def limit_fds(n):
+    def apply():
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, n))
+    return apply
+
+
+def scenario(name, proxy_args, args, origin_port):
+    proxy_port = free_port()
+    command = [sys.executable, os.path.join(ROOT, 'socks5.py'), '-P', str(proxy_port)] + proxy_args.split()
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             preexec_fn=limit_fds(args.proxy_fds))
+    attacker = None
+    try:
+        wait_listening(proxy_port)
+        attacker = multiprocessing.Process(
+            target=attack, args=(proxy_port, args.attackers, args.interval, args.duration + 2), daemon=True)
+        attacker.start()
+        time.sleep(2)  # Let the flood build up
+
+        async def run():
+            latencies, errors = [], []
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(*(legit_client(proxy_port, origin_port, deadline, latencies, errors)
+                                   for _ in range(args.clients)))
+            return sorted(latencies), len(errors)
+
+        latencies, errors = asyncio.run(run())
+    finally:
+        if attacker is not None:
+            attacker.terminate()
+        proxy.terminate()
+        proxy.wait()
+
+    total = len(latencies) + errors
+    line = f"{name:12} [{proxy_args}] ok={len(latencies)}/{total}"
+    if latencies:
+        line += (f" p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms"
+                 f" max={latencies[-1] * 1000:.1f}ms")
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Slowloris stress test for socks5.py')
+    parser.add_argument('--attackers', type=int, default=1500, help="Concurrent slow connections [default: 1500]")
+    parser.add_argument('--interval', type=float, default=1, help="Seconds between attacker bytes [default: 1]")
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent legitimate clients [default: 8]")
+    parser.add_argument('--duration', type=float, default=15, help="Seconds to measure [default: 15]")
+    parser.add_argument('--proxy-fds', type=int, default=1024, help="Proxy RLIMIT_NOFILE [default: 1024]")
+    parser.add_argument('--proxy-args', type=str, default=DEFAULT_PROXY_ARGS,
+                        help=f"socks5.py options for the protected run [default: {DEFAULT_PROXY_ARGS}]")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.attackers + 1024)), hard))
+
+    origin_port = free_port()
+    origin_process = multiprocessing.Process(target=origin, args=(origin_port,), daemon=True)
+    origin_process.start()
+    wait_listening(origin_port)
+    try:
+        scenario('unprotected', '--handshake-timeout 0', args, origin_port)
+        scenario('protected', args.proxy_args, args, origin_port)
+    finally:
+        origin_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
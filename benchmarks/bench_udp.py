@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+UDP ASSOCIATE round trips through socks5.py against a local UDP echo server.
+
+    python3 benchmarks/bench_udp.py --clients 4 --window 32 --duration 10
+
+Every client opens its own association and keeps --window datagrams of
+--size bytes in flight. The report shows echoed packets/s and round trip
+latency, through the proxy and (for comparison) straight to the echo server.
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+from _common import free_port, wait_listening, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAMP = struct.Struct('!d')
+
+
+def echo_server(port):
+    class Echo(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.transport.sendto(data, addr)
+
+    async def serve():
+        await asyncio.get_running_loop().create_datagram_endpoint(Echo, local_addr=('127.0.0.1', port))
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class Client(asyncio.DatagramProtocol):
+    def __init__(self, header, target, payload, latencies):
+        self.header = header
+        # Proxied replies carry the echo server's address as an IPv4 header, whatever the request used.
+        self.offset = 10 if header else 0
+        self.target = target
+        self.payload = payload
+        self.latencies = latencies
+        self.transport = None
+        self.running = True
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self):
+        self.transport.sendto(self.header + STAMP.pack(time.perf_counter()) + self.payload, self.target)
+
+    def datagram_received(self, data, addr):
+        # Every echo is answered with a new datagram, keeping the window full.
+        sent, = STAMP.unpack_from(data, self.offset)
+        self.latencies.append(time.perf_counter() - sent)
+        if self.running:
+            self.send()
+
+
+async def associate(proxy_port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    writer.write(b'\x05\x01\x00')
+    await reader.readexactly(2)
+    writer.write(b'\x05\x03\x00\x01\x00\x00\x00\x00\x00\x00')
+    reply = await reader.readexactly(10)
+    if reply[1] != 0:
+        raise RuntimeError(f"UDP ASSOCIATE failed, REP {reply[1]}")
+    return writer, (socket.inet_ntoa(reply[4:8]), struct.unpack('!H', reply[8:10])[0])
+
+
+async def run(args, echo_port, proxy_port, domain=False):
+    loop = asyncio.get_running_loop()
+    latencies = []
+    clients = []
+    controls = []
+    payload = b'x' * max(0, args.size - STAMP.size)
+    for _ in range(args.clients):
+        if proxy_port:
+            control, relay = await associate(proxy_port)
+            controls.append(control)
+            if domain:
+                # ATYP 3 with a name that resolves without a DNS server, through the proxy's domain path.
+                header = b'\x00\x00\x00\x03\x09127.0.0.1' + struct.pack('!H', echo_port)
+            else:
+                header = b'\x00\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', echo_port)
+            target = relay
+        else:
+            header, target = b'', ('127.0.0.1', echo_port)
+        _, client = await loop.create_datagram_endpoint(
+            lambda: Client(header, target, payload, latencies), local_addr=('127.0.0.1', 0))
+        clients.append(client)
+
+    for client in clients:
+        for _ in range(args.window):
+            client.send()
+    await asyncio.sleep(args.duration)
+    for client in clients:
+        client.running = False
+    count = len(latencies)
+    for client in clients:
+        client.transport.close()
+    for control in controls:
+        control.close()
+    return count, sorted(latencies[:count])
+
+
+def report(name, count, latencies, duration):
+    if not latencies:
+        print(f"{name:6} no echoes received")
+        return
+    print(f"{name:6} {count / duration:10.0f} packets/s p50={percentile(latencies, 50) * 1000:.3f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SOCKS5 UDP ASSOCIATE benchmark')
+    parser.add_argument('--clients', type=int, default=4, help="Associations [default: 4]")
+    parser.add_argument('--window', type=int, default=32, help="Datagrams in flight per client [default: 32]")
+    parser.add_argument('--size', type=int, default=64, help="Payload bytes [default: 64]")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per run [default: 10]")
+    args = parser.parse_args()
+
+    echo_port = free_port(socket.SOCK_DGRAM)
+    echo = multiprocessing.Process(target=echo_server, args=(echo_port,), daemon=True)
+    echo.start()
+
+    proxy_port = free_port()
+    proxy = subprocess.Popen([sys.executable, os.path.join(ROOT, 'socks5.py'), '-P', str(proxy_port)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(proxy_port)
+        time.sleep(0.5)  # Echo server start
+        report('direct', *asyncio.run(run(args, echo_port, None)), args.duration)
+        report('proxy', *asyncio.run(run(args, echo_port, proxy_port)), args.duration)
+        report('domain', *asyncio.run(run(args, echo_port, proxy_port, domain=True)), args.duration)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        echo.terminate()
+
+
+if __name__ == '__main__':
+    main()
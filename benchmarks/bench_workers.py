@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+SOCKS5 connection throughput against the number of --workers.
+
+    python3 benchmarks/bench_workers.py --workers 1 2 4 8 --duration 10
+
+Each connection does a no-auth handshake, CONNECTs to a local echo origin,
+round-trips one byte and closes. The origin and the load generator run in
+their own processes so they do not share a core with a single worker.
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+from _common import free_port, wait_listening
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def origin(port):
+    async def echo(reader, writer):
+        data = await reader.read(1)
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(echo, '127.0.0.1', port, reuse_port=True, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def client(proxy_port, origin_port, concurrency, duration, results):
+    request = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', origin_port)
+
+    async def worker(deadline):
+        done = errors = 0
+        while time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                writer.write(b'\x05\x01\x00')
+                await reader.readexactly(2)
+                writer.write(request)
+                reply = await reader.readexactly(10)
+                if reply[1] != 0:
+                    raise ConnectionError(f"REP {reply[1]}")
+                writer.write(b'x')
+                await reader.readexactly(1)
+                writer.close()
+                done += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+        return done, errors
+
+    async def run():
+        deadline = time.monotonic() + duration
+        counts = await asyncio.gather(*(worker(deadline) for _ in range(concurrency)))
+        results.put((sum(c[0] for c in counts), sum(c[1] for c in counts)))
+
+    asyncio.run(run())
+
+
+def bench(workers, args, origin_port):
+    proxy_port = free_port()
+    proxy = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'socks5.py'), '-P', str(proxy_port), '-w', str(workers)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_listening(proxy_port)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=client,
+                                    args=(proxy_port, origin_port, args.concurrency, args.duration, results))
+            for _ in range(args.clients)
+        ]
+        for p in clients:
+            p.start()
+        counts = [results.get() for _ in clients]
+        for p in clients:
+            p.join()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    done = sum(c[0] for c in counts)
+    errors = sum(c[1] for c in counts)
+    return done / args.duration, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SOCKS5 worker scaling benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per run [default: 10]")
+    parser.add_argument('--clients', type=int, default=os.cpu_count() or 1,
+                        help="Load generator processes [default: cpu count]")
+    parser.add_argument('--concurrency', type=int, default=64, help="Connections in flight per client process")
+    args = parser.parse_args()
+
+    origin_port = free_port()
+    origins = [multiprocessing.Process(target=origin, args=(origin_port,), daemon=True)
+               for _ in range(os.cpu_count() or 1)]
+    for p in origins:
+        p.start()
+    wait_listening(origin_port)
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} client process(es) x {args.concurrency}")
+    base = None
+    for workers in args.workers:
+        rate, errors = bench(workers, args, origin_port)
+        base = base or rate
+        print(f"workers={workers:<3} {rate:10.0f} conn/s  x{rate / base:4.2f}  errors={errors}")
+
+    for p in origins:
+        p.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os
+import abc
+import sys
+import time
+import hmac
+import base64
+import asyncio
+import getpass
+import hashlib
+import logging
+import secrets
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import bcrypt
+except ImportError:  # bcrypt ($2y$) entries need the optional bcrypt package
+    bcrypt = None
+
+logger = logging.getLogger('zzapp')
+
+# Same defaults and format as passlib's pbkdf2_sha256: $pbkdf2-sha256$rounds$salt$checksum
+PBKDF2_ROUNDS = 29000
+PBKDF2_PREFIX = '$pbkdf2-sha256$'
+
+# Seconds between mtime checks of an htpasswd file.
+CHECK_INTERVAL = 1.0
+
+# Failures for users that do not exist are counted under this name, so clients can not
+# create new per-user series by trying random names.
+UNKNOWN_USER = ''
+
+ITOA64 = b'./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def _ab64_encode(data):
+    return base64.b64encode(data).decode().replace('+', '.').rstrip('=')
+
+
+def _ab64_decode(text):
+    text = text.replace('.', '+')
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def hash_password(password, rounds=PBKDF2_ROUNDS):
+    """Hash `password` for an htpasswd file (pbkdf2-sha256)."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, rounds)
+    return f"{PBKDF2_PREFIX}{rounds}${_ab64_encode(salt)}${_ab64_encode(digest)}"
+
+
+def apr1(password, salt):
+    """Apache's MD5-based crypt ($apr1$), the default of `htpasswd` without -B/-s."""
+    password = password.encode()
+    salt = salt.encode()[:8]
+    final = hashlib.md5(password + salt + password).digest()
+    ctx = password + b'$apr1$' + salt
+    for n in range(len(password), 0, -16):
+        ctx += final[:min(16, n)]
+    n = len(password)
+    while n:
+        ctx += b'\0' if n & 1 else password[:1]
+        n >>= 1
+    final = hashlib.md5(ctx).digest()
+
+    for i in range(1000):
+        ctx = password if i & 1 else final
+        if i % 3:
+            ctx += salt
+        if i % 7:
+            ctx += password
+        ctx += final if i & 1 else password
+        final = hashlib.md5(ctx).digest()
+
+    out = bytearray()
+    for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5)):
+        v = final[a] << 16 | final[b] << 8 | final[c]
+        for _ in range(4):
+            out.append(ITOA64[v & 0x3f])
+            v >>= 6
+    v = final[11]
+    for _ in range(2):
+        out.append(ITOA64[v & 0x3f])
+        v >>= 6
+    return f"$apr1${salt.decode()}${out.decode()}"
+
+
+def scheme(hashed):
+    """The hash scheme of an htpasswd entry, or None when it is not supported."""
+    if hashed.startswith(PBKDF2_PREFIX):
+        return 'pbkdf2-sha256'
+    if hashed.startswith('$apr1$'):
+        return 'apr1'
+    if hashed.startswith('{SHA}'):
+        return 'sha1'
+    if hashed.startswith(('$2y$', '$2b$', '$2a$')) and bcrypt is not None:
+        return 'bcrypt'
+    return None
+
+
+def check_password(hashed, password):
+    """
+    Check `password` against an htpasswd hash, comparing in constant time.
+    Blocking and, except for {SHA}, deliberately slow.
+    """
+    kind = scheme(hashed)
+    if kind == 'pbkdf2-sha256':
+        try:
+            rounds, salt, digest = hashed[len(PBKDF2_PREFIX):].split('$')
+            expected = _ab64_decode(digest)
+            actual = hashlib.pbkdf2_hmac('sha256', password.encode(), _ab64_decode(salt), int(rounds))
+        except ValueError:
+            return False
+        return hmac.compare_digest(actual, expected)
+    if kind == 'apr1':
+        salt = hashed[len('$apr1$'):].split('$', 1)[0]
+        return hmac.compare_digest(apr1(password, salt).encode(), hashed.encode())
+    if kind == 'sha1':
+        actual = '{SHA}' + base64.b64encode(hashlib.sha1(password.encode()).digest()).decode()
+        return hmac.compare_digest(actual.encode(), hashed.encode())
+    if kind == 'bcrypt':
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    return False
+
+
+class CredentialStore(abc.ABC):
+    """
+    Username/password check used by the SOCKS5 proxy.
+    Backends implement check() and exists(); verify() adds the per-user success/failure counters.
+    reload() re-reads the backing data, open tunnels are not affected. Backends that have any
+    set `reloadable`, the proxy only installs its SIGHUP handler for those.
+    """
+    reloadable = False
+
+    def __init__(self):
+        self.successes = Counter()
+        self.failures = Counter()
+
+    async def verify(self, user, password):
+        ok = await self.check(user, password)
+        if ok:
+            self.successes[user] += 1
+        else:
+            self.failures[user if self.exists(user) else UNKNOWN_USER] += 1
+        return ok
+
+    @abc.abstractmethod
+    async def check(self, user, password):
+        """True when `password` is right for `user`."""
+
+    @abc.abstractmethod
+    def exists(self, user):
+        """True when `user` is known, failures of unknown users are counted under UNKNOWN_USER."""
+
+    def reload(self):
+        pass
+
+    def stats(self):
+        return {
+            'successes': sum(self.successes.values()),
+            'failures': sum(self.failures.values()),
+        }
+
+
+class StaticCredentials(CredentialStore):
+    """The single --user/--password pair."""
+
+    def __init__(self, user, password):
+        super().__init__()
+        self.user = user.encode()
+        self.password = password.encode()
+
+    async def check(self, user, password):
+        # & instead of `and`: both comparisons always run.
+        return hmac.compare_digest(user.encode(), self.user) & hmac.compare_digest(password.encode(), self.password)
+
+    def exists(self, user):
+        return user.encode() == self.user
+
+
+class HtpasswdFile(CredentialStore):
+    """
+    Users from an htpasswd-style file, one `user:hash` per line (pbkdf2-sha256, apr1, {SHA},
+    and bcrypt when the bcrypt package is installed).
+    The file is re-read on reload() (SIGHUP) and when its mtime changes.
+    Successful checks are cached for `cache_ttl` seconds, keyed by an HMAC of the password
+    under a per-process random key, so the plain password is never kept. Hash checks run on
+    `threads` worker threads (0: on the event loop), and concurrent checks of the same
+    credentials share one.
+    """
+    reloadable = True
+
+    def __init__(self, path, cache_ttl=300.0, threads=4):
+        super().__init__()
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.threads = threads
+        self.users = {}
+        self._stamp = None
+        self._next_check = 0.0
+        self._secret = secrets.token_bytes(32)
+        self._cache = {}  # user -> (HMAC of the password, hash it matched, expires)
+        self._inflight = {}
+        self._executor = None
+        # Unknown users are checked against this, so they take as long as real ones.
+        self._dummy = hash_password(secrets.token_hex(8))
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+        self.reloads = 0
+
+        self.load()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'users': len(self.users),
+            'cached': len(self._cache),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'coalesced': self.coalesced,
+            'reloads': self.reloads,
+        })
+        return stats
+
+    def load(self):
+        """Read the file, raises OSError when it can not be read."""
+        st = os.stat(self.path)
+        users = {}
+        with open(self.path, encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                user, sep, hashed = line.partition(':')
+                if not sep or scheme(hashed) is None:
+                    logger.warning("%s:%s: unsupported entry for user '%s', skipped", self.path, lineno, user)
+                    continue
+                users[user] = hashed
+
+        self.users = users
+        self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        # Entries verified against a hash that changed or went away are dropped.
+        self._cache = {user: entry for user, entry in self._cache.items() if users.get(user) == entry[1]}
+        logger.info("Loaded %s user(s) from %s", len(users), self.path)
+
+    def reload(self):
+        try:
+            self.load()
+            self.reloads += 1
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error("Reloading %s failed, keeping %s user(s): %s", self.path, len(self.users), e)
+
+    def exists(self, user):
+        return user in self.users
+
+    async def check(self, user, password):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + CHECK_INTERVAL
+            self._check_file()
+
+        hashed = self.users.get(user)
+        key = hmac.new(self._secret, password.encode(), 'sha256').digest()
+        entry = self._cache.get(user)
+        if entry is not None and entry[2] > now and entry[1] == hashed and hmac.compare_digest(entry[0], key):
+            self.cache_hits += 1
+            return True
+        self.cache_misses += 1
+
+        if hashed is None:
+            await self._check_hash(self._dummy, password, ('', key))
+            return False
+
+        ok = await self._check_hash(hashed, password, (user, key))
+        if ok and self.cache_ttl > 0:
+            self._cache[user] = (key, hashed, time.monotonic() + self.cache_ttl)
+        return ok
+
+    def _check_file(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return  # Keep the last good list until the file is back
+        if (st.st_ino, st.st_mtime_ns, st.st_size) != self._stamp:
+            logger.info("%s changed, reloading.", self.path)
+            self.reload()
+
+    async def _check_hash(self, hashed, password, key):
+        if not self.threads:
+            return check_password(hashed, password)
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            if self._executor is None:
+                # Created on first use, so every worker process gets its own threads.
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='auth')
+            fut = asyncio.get_running_loop().run_in_executor(self._executor, check_password, hashed, password)
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: a client timing out must not cancel a check other clients wait on.
+        return await asyncio.shield(fut)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add or update a user in an htpasswd file (pbkdf2-sha256)')
+    parser.add_argument('file', help="htpasswd file, created when missing")
+    parser.add_argument('user', help="Username")
+    parser.add_argument('--rounds', type=int, default=PBKDF2_ROUNDS, help=f"PBKDF2 rounds [default: {PBKDF2_ROUNDS}]")
+    parser.add_argument('--stdin', action='store_true', help="Read the password from stdin instead of prompting")
+    args = parser.parse_args()
+
+    if ':' in args.user:
+        parser.error("The username can not contain ':'.")
+    password = sys.stdin.readline().rstrip('\n') if args.stdin else getpass.getpass()
+
+    lines = []
+    if os.path.exists(args.file):
+        with open(args.file, encoding='utf-8') as f:
+            lines = [line for line in f.read().splitlines() if line.partition(':')[0] != args.user]
+    lines.append(f"{args.user}:{hash_password(password, args.rounds)}")
+
+    # Write a new file and rename it over the old one, a running proxy never sees it half written.
+    tmp = f"{args.file}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, args.file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import time
+import errno
+import socket
+import asyncio
+import logging
+import ipaddress
+from collections import OrderedDict
+
+logger = logging.getLogger('zzapp')
+
+# SOCKS5 REP codes (RFC 1928)
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+
+_ERRNO_REPS = {
+    errno.ENETUNREACH: REP_NETWORK_UNREACHABLE,
+    errno.ENETDOWN: REP_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REP_HOST_UNREACHABLE,
+    errno.EHOSTDOWN: REP_HOST_UNREACHABLE,
+    errno.ECONNREFUSED: REP_CONNECTION_REFUSED,
+    errno.ETIMEDOUT: REP_TTL_EXPIRED,
+}
+
+
+class DialError(OSError):
+    def __init__(self, rep, message):
+        super().__init__(message)
+        self.rep = rep
+
+
+def reply_code(exc):
+    """Map a resolve/connect failure to a SOCKS5 REP code."""
+    if isinstance(exc, DialError):
+        return exc.rep
+    if isinstance(exc, socket.gaierror):
+        return REP_HOST_UNREACHABLE
+    if isinstance(exc, TimeoutError):
+        return REP_TTL_EXPIRED
+    if isinstance(exc, OSError):
+        return _ERRNO_REPS.get(exc.errno, REP_GENERAL_FAILURE)
+    return REP_GENERAL_FAILURE
+
+
+class Dialer:
+    """
+    Upstream dialer doing Happy Eyeballs (RFC 8305) over already resolved addresses.
+    Attempts alternate between address families and start `attempt_delay` seconds
+    apart (or as soon as the previous one fails), the first to connect wins and the
+    whole dial is bounded by `timeout`.
+
+    Addresses that time out, are unreachable or lose a race they started first on a
+    port are tried last by later dials to that port for `failure_ttl` seconds.
+    """
+
+    def __init__(self, timeout=10.0, attempt_delay=0.25, failure_ttl=30.0, max_failures=4096):
+        self.timeout = timeout
+        self.attempt_delay = attempt_delay
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self._failures = OrderedDict()  # (address, port) -> expires
+
+    async def dial(self, addresses, port):
+        candidates = self._candidates(addresses, port)
+        if not candidates:
+            raise DialError(REP_HOST_UNREACHABLE, "No address to connect to")
+        return await self._race(candidates, port)
+
+    async def _race(self, addresses, port):
+        deadline = time.monotonic() + self.timeout
+        pending = list(addresses)
+        attempts = {}  # task -> (address, start time)
+        errors = []
+        try:
+            while pending or attempts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Whatever is still connecting at the deadline is effectively blackholed.
+                    for address, _ in attempts.values():
+                        self._remember(address, port, REP_TTL_EXPIRED)
+                    raise DialError(REP_TTL_EXPIRED, f"Connect timed out after {self.timeout}s")
+
+                if pending:
+                    address = pending.pop(0)
+                    task = asyncio.create_task(asyncio.open_connection(address, port), name=f"dial_{address}")
+                    attempts[task] = (address, time.monotonic())
+
+                done, _ = await asyncio.wait(
+                    attempts, timeout=min(self.attempt_delay, remaining) if pending else remaining,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    address, started = attempts.pop(task)
+                    exc = task.exception()
+                    if exc is None:
+                        self._forget(address, port)
+                        self._outrun(attempts, started, port)
+                        return task.result()
+                    logger.debug("Connect to %s:%s failed: %s", address, port, exc)
+                    errors.append(exc)
+                    self._remember(address, port, reply_code(exc))
+        finally:
+            for task in attempts:
+                task.cancel()
+            # A loser may have connected right before being cancelled.
+            for result in await asyncio.gather(*attempts, return_exceptions=True):
+                if isinstance(result, tuple):
+                    result[1].close()
+
+        raise DialError(reply_code(errors[-1]), str(errors[-1]))
+
+    def _candidates(self, addresses, port):
+        """Healthy addresses interleaved by family, then the ones that recently failed on `port`."""
+        now = time.monotonic()
+        families = {}
+        failed = []
+        for address in addresses:
+            expires = self._failures.get((address, port))
+            if expires is not None:
+                if expires > now:
+                    failed.append(address)
+                    continue
+                del self._failures[(address, port)]
+            families.setdefault(ipaddress.ip_address(address.split('%')[0]).version, []).append(address)
+
+        # The resolver already put the preferred family first.
+        groups = list(families.values())
+        candidates = []
+        while groups:
+            for group in list(groups):
+                candidates.append(group.pop(0))
+                if not group:
+                    groups.remove(group)
+        # Still worth a try, e.g. when they are all there is, just after everything else.
+        return candidates + failed
+
+    def _outrun(self, attempts, winner_started, port):
+        # An attempt started before the winner and still hanging (e.g. a broken AAAA) is not worth trying first again.
+        for address, started in attempts.values():
+            if started < winner_started:
+                self._remember(address, port, REP_TTL_EXPIRED)
+
+    def _remember(self, address, port, rep):
+        if rep == REP_CONNECTION_REFUSED or self.failure_ttl <= 0:
+            return  # Refusals fail fast anyway.
+        key = (address, port)
+        self._failures[key] = time.monotonic() + self.failure_ttl
+        self._failures.move_to_end(key)
+        while len(self._failures) > self.max_failures:
+            self._failures.popitem(last=False)
+
+    def _forget(self, address, port):
+        self._failures.pop((address, port), None)
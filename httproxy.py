@@ -1 +1,612 @@
-#!/usr/bin/env python3import asyncioimport loggingimport sysimport urllib.parseimport argparseimport daemonfrom daemon import pidfileimport util__NAME__ = 'ZZHttpProxy'__VERSION__ = "2.0"logger = logging.getLogger('zzapp')class AsyncProxy:    def __init__(self, host, port):        self.host = host        self.port = port    async def start(self):        server = await asyncio.start_server(            self.handle_client, self.host, self.port        )        addr = server.sockets[0].getsockname()        logger.info(f"Serving HTTP on {addr[0]}:{addr[1]}")        async with server:            await server.serve_forever()    async def handle_client(self, reader, writer):        addr = ':'.join([str(x) for x in writer.get_extra_info('peername')])        logger.debug(f"Accepted connection from {addr}")        try:            line = await reader.readline()            if not line:                logger.warning(f"Client {addr} disconnected before sending request.")                return            try:                request_line = line.decode('iso-8859-1').rstrip()                parts = request_line.split()                if len(parts) == 3:                    method, path, version = parts                elif len(parts) == 2:                    method, path = parts                    version = "HTTP/0.9"                else:                    raise ValueError("Invalid request line")            except ValueError:                logger.warning(f"Malformed request line from {addr}: {line}")                return            logger.info(f"Request from {addr}: {method} {path} {version}")            if method == 'CONNECT':                await self.handle_connect(reader, writer, path)            else:                await self.handle_http(reader, writer, method, path, version)        except Exception as e:            logger.error(f"Error handling request from {addr}: {e}", exc_info=True)        finally:            if not writer.is_closing():                logger.debug(f"Closing connection to {addr}")                writer.close()                try:                    await writer.wait_closed()                except Exception:                    pass            logger.debug(f"Connection to {addr} is fully closed.")    async def handle_connect(self, client_reader, client_writer, netloc):        host_port = AsyncProxy._get_host_port(netloc)        if not host_port:            return        host, port = host_port        client_addr = ':'.join([str(x) for x in client_writer.get_extra_info('peername')])        logger.debug(f"[{client_addr}] CONNECT request to {host}:{port}")        while True:            line = await client_reader.readline()            if not line or line == b'\r\n':                break        try:            upstream_reader, upstream_writer = await asyncio.open_connection(host, port)        except Exception as e:            logger.error(f"[{client_addr}] Failed to connect to {host}:{port}: {e}")            client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")            await client_writer.drain()            return        upstream_addr = upstream_writer.get_extra_info('peername')        logger.debug(f"[{client_addr}] Connection to upstream {upstream_addr} established.")        client_writer.write(b"HTTP/1.1 200 Connection established\r\n")        client_writer.write(f"Proxy-agent: {__NAME__}/{__VERSION__}\r\n".encode())        client_writer.write(b"\r\n")        await client_writer.drain()        logger.debug(f"[{client_addr}] Sent 200 OK to client, starting pipe.")        await self.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer)        logger.debug(f"[{client_addr}] pipe_bi finished for {upstream_addr}.")    async def handle_http(self, client_reader, client_writer, method, path, version):        client_addr = ':'.join([str(x) for x in client_writer.get_extra_info('peername')])        scm, netloc, path, params, query, fragment = urllib.parse.urlparse(path, 'http')        if not netloc:            logger.warning(f"Bad URL: {path}")            client_writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")            await client_writer.drain()            return        host_port = self._get_host_port(netloc)        if not host_port:            return        host, port = host_port        headers = {}        while True:            line = await client_reader.readline()            if not line or line == b'\r\n':                break            try:                key, value = line.decode('iso-8859-1').split(':', 1)                headers[key.strip()] = value.strip()            except:                pass        logger.debug(f"Proxying HTTP {method} to {host}:{port}")        try:            upstream_reader, upstream_writer = await asyncio.open_connection(host, port)        except Exception as e:            logger.error(f"[{client_addr}] Connect to {host}:{port} failed: {e}")            client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")            await client_writer.drain()            return        full_path = urllib.parse.urlunparse(('', '', path, params, query, ''))        req_line = f"{method} {full_path} {version}\r\n"        upstream_writer.write(req_line.encode('iso-8859-1'))        connection_key = next((k for k in headers if k.lower() == 'connection'), None)        is_upgrade = False        if connection_key and 'upgrade' in headers[connection_key].lower():            is_upgrade = True        proxy_connection_key = next((k for k in headers if k.lower() == 'proxy-connection'), None)        if proxy_connection_key:            del headers[proxy_connection_key]        if not is_upgrade:            if connection_key:                del headers[connection_key]            headers['Connection'] = 'close'        for k, v in headers.items():            upstream_writer.write(f"{k}: {v}\r\n".encode('iso-8859-1'))        upstream_writer.write(b'\r\n')        await upstream_writer.drain()        await self.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer)    @staticmethod    def _get_host_port(netloc):        try:            if ':' in netloc:                host, port = netloc.split(':')                return host, int(port)            else:                return netloc, 80        except ValueError:            return None    @staticmethod    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source_peer: str, dest_peer: str):        try:            while True:                data = await reader.read(4096)                if not data:                    break                writer.write(data)                await writer.drain()        except asyncio.CancelledError:            raise        except (ConnectionResetError, BrokenPipeError):            logger.debug(f"Connection reset/broken from {source_peer} to {dest_peer}.")        except Exception as e:            logger.error(f"Pipe error from {source_peer} to {dest_peer}: {e}", exc_info=True)        finally:            if not writer.is_closing():                writer.close()                try:                    await writer.wait_closed()                except Exception:                    pass    @staticmethod    async def pipe_bi(reader1, writer1, reader2, writer2):        peer1 = ':'.join([str(x) for x in writer1.get_extra_info('peername')])        peer2 = ':'.join([str(x) for x in writer2.get_extra_info('peername')])        logger.debug(f"Piping data between {peer1} and {peer2}")        async with asyncio.TaskGroup() as tg:            tg.create_task(AsyncProxy.pipe(reader1, writer2, peer1, peer2), name=f"pipe_{peer1}_to_{peer2}")            tg.create_task(AsyncProxy.pipe(reader2, writer1, peer2, peer1), name=f"pipe_{peer2}_to_{peer1}")        logger.debug(f"Pipe between {peer1} and {peer2} finished.")def usage():    parser = argparse.ArgumentParser(description=f'{__NAME__}')    parser.add_argument('-H', '--host', type=str, dest="host", default='127.0.0.1',                        help="Host to bind to [default: 127.0.0.1]")    parser.add_argument('-P', '--port', type=int, dest="port", default='8000',                        help="Port to bind to [default: 8000]")    parser.add_argument('-l', '--logfile', type=str, dest="logfile", default='STDOUT',                        help="Path to the logfile [default: STDOUT]")    parser.add_argument('-p', '--pidfile', type=str, dest="pidfile", default=None,                        help=f"Path to the pidfile [default: /tmp/{__NAME__.lower()}.pid]")    parser.add_argument('-d', '--daemon', action='store_true', dest="daemon", default=False,                        help="Daemonize (run in the background). Daemon mode must specify logfile")    parser.add_argument('-v', '--verbose', action='store_true', dest="verbose", default=False,                        help="Log debug info")    args = parser.parse_args()    if args.daemon and args.logfile in ('-', 'STDOUT'):        parser.error("Daemon mode requires a logfile path.")    return argsdef main():    args = usage()    if not (0 < args.port < 65536):        print(f'Port[{args.port}] invalid', file=sys.stderr)        sys.exit(1)    logger = util.setup_logging(args.logfile, 20, args.verbose)    if args.daemon:        context = daemon.DaemonContext(            working_directory='/tmp',            umask=0o022,            pidfile=pidfile.TimeoutPIDLockFile(args.pidfile),            files_preserve=[handler.stream.fileno() for handler in logger.handlers],            stdout=logger.handlers[0].stream,            stderr=logger.handlers[0].stream,        )        try:            with context:                logger.info("Daemon process started.")                proxy = AsyncProxy(args.host, args.port)                asyncio.run(proxy.start())        except Exception as e:            logger.critical(f"Daemon failed to start: {e}")            sys.exit(1)    else:        try:            logger.info("Starting proxy in foreground.")            proxy = AsyncProxy(args.host, args.port)            asyncio.run(proxy.start())        except KeyboardInterrupt:            logger.info("Proxy stopped by user.")        except Exception as e:            logger.error(f"An unexpected error occurred: {e}", exc_info=True)if __name__ == '__main__':    main()
\ No newline at end of file
+#!/usr/bin/env python3
+
+import re
+import asyncio
+import logging
+import argparse
+from urllib.parse import urlsplit
+
+import util
+import dialer
+import admission
+from pool import ConnectionPool
+from socks5 import Socks5Proxy
+from server import ProxyServer
+
+__NAME__ = 'ZZHttproxy'
+__VERSION__ = "1.0"
+
+logger = logging.getLogger('zzapp')
+# One line per tunnel/request, can be sampled with --access-log-sample.
+access_logger = logging.getLogger('zzapp.access')
+
+BUFFER_SIZE = 1 << 16
+
+# A chunk size is nothing but hex digits (RFC 7230 4.1); int(x, 16) would also take signs, '0x', '_' and spaces.
+CHUNK_SIZE = re.compile(rb'[0-9A-Fa-f]{1,16}')
+# Left in a line after splitting on CRLF, a recipient that accepts bare LF would see a different message.
+BAD_HEAD_CHAR = re.compile('[\r\n\0]')
+
+# RFC 7230 6.1, never forwarded as they are. Transfer-Encoding is kept: bodies are relayed with their
+# original framing. Upgrade and `Connection: Upgrade` are added back for protocol upgrades (e.g. WebSocket).
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'upgrade',
+))
+
+# RFC 9110 9.2.2, requests that can be sent again when a pooled connection turns out to be stale.
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'))
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
+
+
+class OriginClosed(Exception):
+    """The origin closed the connection before sending a response."""
+
+
+class HttpProxy(ProxyServer):
+    protocol = 'HTTP proxy'
+
+    def __init__(self, host, port, relay_engine='auto', dns=None, upstream=None, pool=None, metrics=None,
+                 limits=None):
+        super().__init__(host, port, relay_engine, dns, upstream, metrics, limits)
+        self.pool = pool or ConnectionPool()
+
+    def stat_sources(self):
+        return super().stat_sources() + [('upstream_pool', 'Upstream keep-alive pool', self.pool.stats)]
+
+    async def drain(self, timeout):
+        await super().drain(timeout)
+        self.pool.close()
+
+    async def handle_client(self, reader, writer):
+        peername = writer.get_extra_info('peername')
+        addr = ':'.join([str(x) for x in peername])
+        limits = self.limits
+        rejected = limits.admit(peername[0])
+        if rejected:
+            logger.debug("Rejected connection from %s (%s limit)", addr, rejected)
+            if rejected == admission.RATE:
+                writer.write(error_response(429, 'Too Many Requests'))
+            else:
+                writer.write(error_response(503, 'Service Unavailable'))
+            writer.close()
+            return
+        logger.debug("Accepted connection from %s", addr)
+        task = asyncio.current_task()
+        self.clients.add(task)
+        if self.metrics:
+            self.metrics.connections_total.inc()
+            self.metrics.connections_active.inc()
+
+        try:
+            keep_alive = True
+            first = True
+            while keep_alive:
+                # Also bounds how long an idle keep-alive connection waits for its next request.
+                try:
+                    async with asyncio.timeout(limits.handshake_timeout):
+                        head = await read_head(reader)
+                except TimeoutError:
+                    if first:
+                        limits.handshake_timeouts += 1
+                        logger.warning("Request header timeout for %s.", addr)
+                        await send_error(writer, 408, 'Request Timeout')
+                    break
+                first = False
+                if head is None:
+                    break
+                (method, target, version), headers = head
+
+                if method == 'CONNECT':
+                    await self.handle_connect(reader, writer, addr, target)
+                    break
+                keep_alive = await self.handle_request(reader, writer, addr, method, target, version, headers)
+
+        except HttpError as e:
+            logger.warning("Bad request from %s: %s", addr, e)
+            await send_error(writer, e.status, e.reason)
+        except asyncio.IncompleteReadError:
+            logger.warning("Client %s disconnected unexpectedly.", addr)
+        except ValueError as e:
+            logger.warning("Malformed message body on %s: %s", addr, e)
+        except (ConnectionResetError, BrokenPipeError):
+            logger.debug("Connection reset/broken from %s.", addr)
+        except Exception as e:
+            logger.error("Error handling client %s: %s", addr, e, exc_info=True)
+        finally:
+            self.clients.discard(task)
+            limits.release(peername[0])
+            if self.metrics:
+                self.metrics.connections_active.dec()
+            if not writer.is_closing():
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+            logger.debug("Connection to %s is fully closed.", addr)
+
+    async def handle_connect(self, client_reader, client_writer, client_addr, target):
+        dest_addr, dest_port = split_authority(target, None)
+        if dest_port is None:
+            raise HttpError(400, 'Bad Request')
+
+        access_logger.info("[%s] CONNECT request to %s:%s", client_addr, dest_addr, dest_port,
+                           extra={'access': {'client': str(client_addr), 'method': 'CONNECT',
+                                             'target': f"{dest_addr}:{dest_port}"}})
+        try:
+            upstream_reader, upstream_writer = await self.dial(dest_addr, dest_port)
+        except Exception as e:
+            status, reason = gateway_error(e)
+            logger.error("[%s] Failed to connect to %s:%s: %s", client_addr, dest_addr, dest_port, e)
+            await send_error(client_writer, status, reason)
+            return
+
+        client_writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+        await client_writer.drain()
+
+        m = self.metrics
+        traffic = m.tunnel_opened() if m else None
+        try:
+            await Socks5Proxy.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer,
+                                      self.relay_engine, self.limits, traffic.counts if traffic else None)
+        finally:
+            if traffic:
+                m.tunnel_closed(traffic)
+
+    async def handle_request(self, client_reader, client_writer, client_addr, method, target, version, headers):
+        """
+        Forward one plain HTTP request, streaming both bodies.
+        Returns True when the client connection can be reused for the next request.
+        """
+        url = urlsplit(target)
+        if url.scheme.lower() != 'http' or not url.netloc:
+            raise HttpError(400, 'Bad Request')
+        authority = url.netloc.rpartition('@')[2]  # Without userinfo
+        dest_addr, dest_port = split_authority(authority, 80)
+        path = url.path or '/'
+        if url.query:
+            path = f"{path}?{url.query}"
+
+        request_framing = body_framing(headers)  # Before anything is forwarded: HttpError 400 on ambiguous framing
+        keep_alive = wants_keep_alive(version, headers)
+        upgrade = requested_upgrade(version, headers)
+        access_logger.info("[%s] %s %s", client_addr, method, target,
+                           extra={'access': {'client': str(client_addr), 'method': method, 'target': target}})
+
+        # RFC 7230 5.4: the received Host is replaced by the request-target's authority.
+        out = [f"{method} {path} HTTP/1.1", f"Host: {authority}"]
+        out.extend(f"{name}: {value}" for name, value in filter_headers(headers))
+        if upgrade:
+            out.extend((f"Upgrade: {upgrade}", "Connection: Upgrade"))
+        request_head = ('\r\n'.join(out) + '\r\n\r\n').encode('latin-1')
+
+        key = (dest_addr.lower(), dest_port)
+        # Counted like a tunnel: both heads and bodies, and whatever an upgraded connection carries.
+        m = self.metrics
+        traffic = m.tunnel_opened() if m else None
+        counts = traffic.counts if traffic else None
+        try:
+            while True:
+                upstream = self.pool.acquire(key)
+                reused = upstream is not None
+                if not reused:
+                    try:
+                        upstream = await self.dial(dest_addr, dest_port)
+                    except Exception as e:
+                        status, reason = gateway_error(e)
+                        logger.error("[%s] Failed to connect to %s:%s: %s", client_addr, dest_addr, dest_port, e)
+                        await send_error(client_writer, status, reason, keep_alive and request_framing is None)
+                        return keep_alive and request_framing is None
+
+                upstream_reader, upstream_writer = upstream
+                try:
+                    upstream_writer.write(request_head)
+                    if counts is not None:
+                        counts[0] += len(request_head)
+                    keep_alive, reusable, upgraded = await self.exchange(
+                        client_reader, client_writer, client_addr, upstream_reader, upstream_writer,
+                        method, version, request_framing, keep_alive, upgrade, counts)
+                except OriginClosed:
+                    upstream_writer.close()
+                    if reused and request_framing is None and method in IDEMPOTENT_METHODS:
+                        # The origin dropped an idle pooled connection, nothing was sent to the client yet.
+                        logger.debug("[%s] Pooled connection to %s:%s was stale, retrying.",
+                                     client_addr, dest_addr, dest_port)
+                        continue
+                    raise HttpError(502, 'Bad Gateway')
+                except BaseException:
+                    upstream_writer.close()
+                    raise
+
+                if upgraded:
+                    # 101 Switching Protocols: from here on both connections carry the new protocol as is.
+                    await Socks5Proxy.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer,
+                                              self.relay_engine, self.limits, counts)
+                    return False
+                if reusable:
+                    self.pool.release(key, upstream_reader, upstream_writer)
+                else:
+                    upstream_writer.close()
+                return keep_alive
+        finally:
+            if traffic:
+                m.tunnel_closed(traffic)
+
+    async def exchange(self, client_reader, client_writer, client_addr, upstream_reader, upstream_writer,
+                       method, version, request_framing, keep_alive, upgrade=None, counts=None):
+        # The request body goes up while the response comes down, so 100-continue and early responses work.
+        body_task = asyncio.create_task(
+            copy_body(client_reader, upstream_writer, request_framing, counts, 0), name=f"request_body_{client_addr}")
+        response_task = asyncio.create_task(
+            self.forward_response(upstream_reader, client_writer, method, version, keep_alive, upgrade, counts),
+            name=f"response_{client_addr}")
+        try:
+            pending = {body_task, response_task}
+            while not response_task.done():
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if body_task in done and body_task.exception():
+                    raise body_task.exception()
+            keep_alive, reusable, upgraded = response_task.result()
+            # An origin answering before the whole body was sent leaves both streams out of sync.
+            if not body_task.done():
+                return False, False, False
+            return keep_alive, reusable, upgraded
+        finally:
+            body_task.cancel()
+            response_task.cancel()
+
+    @staticmethod
+    async def forward_response(upstream_reader, client_writer, method, version, keep_alive, upgrade=None,
+                               counts=None):
+        """
+        Relay the origin's response to a client that sent an HTTP `version` request.
+        HTTP/1.0 clients get chunked bodies de-chunked and delimited by closing the connection.
+        `upgrade` is the protocol the client asked to switch to, if any.
+        `counts[1]` (if given) gets the bytes written to the client added.
+        Returns (client keep-alive, upstream connection reusable, switched protocols).
+        """
+        http11 = version == 'HTTP/1.1'
+        while True:
+            try:
+                head = await read_head(upstream_reader)
+            except (asyncio.IncompleteReadError, ConnectionResetError):
+                head = None
+            except HttpError:
+                raise HttpError(502, 'Bad Gateway')
+            if head is None:
+                raise OriginClosed()
+            (response_version, status, reason), headers = head
+            if not status.isdigit():
+                raise HttpError(502, 'Bad Gateway')
+            status = int(status)
+            if 100 <= status < 200 and status != 101:
+                # Interim response (e.g. 100 Continue), forward and wait for the final one.
+                # HTTP/1.0 clients do not know them (RFC 7231 6.2).
+                if http11:
+                    interim = f"HTTP/1.1 {status} {reason}\r\n\r\n".encode('latin-1')
+                    client_writer.write(interim)
+                    if counts is not None:
+                        counts[1] += len(interim)
+                    await client_writer.drain()
+                continue
+            break
+
+        if status == 101:
+            if not upgrade or 'upgrade' not in header_tokens(headers, 'connection'):
+                raise HttpError(502, 'Bad Gateway')
+            out = [f"HTTP/1.1 101 {reason}"]
+            out.extend(f"{name}: {value}" for name, value in filter_headers(headers))
+            out.extend((f"Upgrade: {get_header(headers, 'upgrade') or upgrade}", "Connection: Upgrade"))
+            response_head = ('\r\n'.join(out) + '\r\n\r\n').encode('latin-1')
+            client_writer.write(response_head)
+            if counts is not None:
+                counts[1] += len(response_head)
+            await client_writer.drain()
+            return False, False, True
+
+        try:
+            if method == 'HEAD' or status in (204, 304):
+                framing = None
+            else:
+                framing = body_framing(headers, response=True)
+            forwarded = filter_headers(headers)
+        except HttpError:
+            raise HttpError(502, 'Bad Gateway')
+        dechunk = framing == 'chunked' and not http11
+        if dechunk:
+            # RFC 7230 3.3.1: no Transfer-Encoding: chunked towards an HTTP/1.0 recipient.
+            forwarded = dechunked_headers(forwarded)
+        keep_alive = keep_alive and framing != 'eof' and not dechunk
+        reusable = framing != 'eof' and wants_keep_alive(response_version, headers)
+
+        out = [f"HTTP/1.1 {status} {reason}"]
+        out.extend(f"{name}: {value}" for name, value in forwarded)
+        out.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        response_head = ('\r\n'.join(out) + '\r\n\r\n').encode('latin-1')
+        client_writer.write(response_head)
+        if counts is not None:
+            counts[1] += len(response_head)
+
+        if dechunk:
+            await copy_chunked(upstream_reader, client_writer, dechunk=True, counts=counts, index=1)
+        else:
+            await copy_body(upstream_reader, client_writer, framing, counts, 1)
+        return keep_alive, reusable, False
+
+
+async def read_head(reader):
+    """
+    Read a request/status line and its headers.
+    Returns ((part1, part2, part3), [(name, value), ...]), or None on a clean EOF between messages.
+    HttpError 400 on a malformed head, e.g. a bare CR, LF or NUL in any line.
+    """
+    try:
+        data = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise HttpError(431, 'Request Header Fields Too Large')
+
+    lines = data.decode('latin-1').split('\r\n')
+    if any(BAD_HEAD_CHAR.search(line) for line in lines):
+        raise HttpError(400, 'Bad Request')
+    start = lines[0].split(' ', 2)
+    if len(start) == 2:
+        start.append('')  # Status line without a reason phrase
+    if len(start) != 3:
+        raise HttpError(400, 'Bad Request')
+
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name or name != name.strip():
+            raise HttpError(400, 'Bad Request')
+        headers.append((name, value.strip()))
+    return tuple(start), headers
+
+
+def get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def header_tokens(headers, *names):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() in names:
+            tokens.update(t.strip().lower() for t in value.split(','))
+    return tokens
+
+
+def filter_headers(headers):
+    """
+    The headers to forward: hop-by-hop ones are dropped and Content-Length is sent once,
+    or not at all next to a Transfer-Encoding (RFC 7230 3.3.3). Host is dropped as well,
+    requests get it from the request-target (RFC 7230 5.4).
+    """
+    drop = HOP_BY_HOP | header_tokens(headers, 'connection', 'proxy-connection') | {'content-length', 'host'}
+    forwarded = [(name, value) for name, value in headers if name.lower() not in drop]
+    length = content_length(headers)
+    if length is not None and get_header(headers, 'transfer-encoding') is None:
+        forwarded.append(('Content-Length', str(length)))
+    return forwarded
+
+
+def dechunked_headers(headers):
+    """`headers` of a chunked message with the chunked coding removed from Transfer-Encoding."""
+    forwarded = []
+    for name, value in headers:
+        if name.lower() == 'transfer-encoding':
+            value = ', '.join(t.strip() for t in value.split(',') if t.strip() and t.strip().lower() != 'chunked')
+            if not value:
+                continue
+        forwarded.append((name, value))
+    return forwarded
+
+
+def requested_upgrade(version, headers):
+    """The Upgrade header of an HTTP/1.1 request that lists it in Connection, otherwise None."""
+    if version != 'HTTP/1.1' or 'upgrade' not in header_tokens(headers, 'connection'):
+        return None
+    return get_header(headers, 'upgrade') or None
+
+
+def wants_keep_alive(version, headers):
+    tokens = header_tokens(headers, 'connection', 'proxy-connection')
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+
+def body_framing(headers, response=False):
+    """
+    How the message body is delimited (RFC 7230 3.3.3): None (no body), 'chunked', a Content-Length
+    int, or for responses 'eof' (until the origin closes).
+    Raises HttpError 400 when requests and responses could be framed more than one way: a
+    Transfer-Encoding that is not chunked last (requests only), or conflicting Content-Lengths.
+    """
+    codings = [token.strip().lower() for key, value in headers if key.lower() == 'transfer-encoding'
+               for token in value.split(',') if token.strip()]
+    if codings:
+        # Transfer-Encoding wins over Content-Length, which filter_headers() then drops.
+        if codings[-1] == 'chunked' and codings.count('chunked') == 1:
+            return 'chunked'
+        if response and 'chunked' not in codings:
+            return 'eof'
+        raise HttpError(400, 'Bad Request')
+    length = content_length(headers)
+    if length is None:
+        return 'eof' if response else None
+    return length or None
+
+
+def content_length(headers):
+    """The Content-Length, None without one. Raises HttpError 400 for malformed or differing values."""
+    values = {value.strip() for key, line in headers if key.lower() == 'content-length' for value in line.split(',')}
+    if not values:
+        return None
+    if len(values) > 1:
+        raise HttpError(400, 'Bad Request')
+    value = values.pop()
+    if not (value.isascii() and value.isdigit()):
+        raise HttpError(400, 'Bad Request')
+    return int(value)
+
+
+async def copy_body(reader, writer, framing, counts=None, index=0):
+    # The copy_* functions add what they write to `counts[index]` when given (a metrics.Traffic's counts).
+    if framing is None:
+        return
+    if framing == 'chunked':
+        await copy_chunked(reader, writer, counts=counts, index=index)
+    elif framing == 'eof':
+        while True:
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            if counts is not None:
+                counts[index] += len(data)
+            await writer.drain()
+    else:
+        await copy_exact(reader, writer, framing, counts, index)
+
+
+async def copy_exact(reader, writer, n, counts=None, index=0):
+    while n:
+        data = await reader.read(min(n, BUFFER_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', n)
+        writer.write(data)
+        n -= len(data)
+        if counts is not None:
+            counts[index] += len(data)
+        await writer.drain()
+
+
+async def copy_chunked(reader, writer, dechunk=False, counts=None, index=0):
+    # Chunks are relayed verbatim, only the size lines are parsed to find the end of the body.
+    # With `dechunk` only the chunk data is written, without sizes and trailers.
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        size, sep, _ = line[:-2].partition(b';')
+        if sep:
+            size = size.rstrip(b' \t')  # Whitespace before chunk extensions (RFC 9112 7.1.1)
+        if not CHUNK_SIZE.fullmatch(size):
+            raise ValueError(f"bad chunk size line {line[:32]!r}")
+        size = int(size, 16)
+        if not dechunk:
+            writer.write(line)
+            if counts is not None:
+                counts[index] += len(line)
+        if size == 0:
+            break
+        if dechunk:
+            await copy_exact(reader, writer, size, counts, index)
+            if await reader.readexactly(2) != b'\r\n':
+                raise ValueError("chunk data not followed by CRLF")
+        else:
+            await copy_exact(reader, writer, size + 2, counts, index)  # Chunk data and its CRLF
+
+    while True:  # Trailer section
+        line = await reader.readuntil(b'\r\n')
+        if not dechunk:
+            writer.write(line)
+            if counts is not None:
+                counts[index] += len(line)
+        if line == b'\r\n':
+            break
+    await writer.drain()
+
+
+def split_authority(authority, default_port):
+    """Split 'host[:port]' or '[v6][:port]' into (host, port)."""
+    if authority.startswith('['):
+        host, sep, rest = authority[1:].partition(']')
+        if not sep or (rest and not rest.startswith(':')):
+            raise HttpError(400, 'Bad Request')
+        port = rest[1:]
+    else:
+        host, _, port = authority.partition(':')
+        if ':' in port:
+            raise HttpError(400, 'Bad Request')
+
+    if not port:
+        port = default_port
+    elif not port.isdigit() or not (0 < int(port) < 65536):
+        raise HttpError(400, 'Bad Request')
+    else:
+        port = int(port)
+    if not host:
+        raise HttpError(400, 'Bad Request')
+    return host, port
+
+
+def gateway_error(exc):
+    if dialer.reply_code(exc) == dialer.REP_TTL_EXPIRED:
+        return 504, 'Gateway Timeout'
+    return 502, 'Bad Gateway'
+
+
+def error_response(status, reason, keep_alive=False):
+    connection = 'keep-alive' if keep_alive else 'close'
+    return f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode()
+
+
+async def send_error(writer, status, reason, keep_alive=False):
+    if writer.is_closing():
+        return
+    writer.write(error_response(status, reason, keep_alive))
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+
+def usage():
+    parser = argparse.ArgumentParser(description=f'{__NAME__}')
+    parser.add_argument('-H', '--host', type=str, dest="host", default='127.0.0.1',
+                        help="Host to bind to [default: 127.0.0.1]")
+    parser.add_argument('-P', '--port', type=int, dest="port", default='8000',
+                        help="Port to bind to [default: 8000]")
+    parser.add_argument('-p', '--pidfile', type=str, dest="pidfile", default=None,
+                        help=f"Path to the pidfile [default: /tmp/{__NAME__.lower()}.pid]")
+    parser.add_argument('--pool-max-idle', type=int, dest="pool_max_idle", default=256,
+                        help="Idle keep-alive origin connections kept in total, 0 disables pooling [default: 256]")
+    parser.add_argument('--pool-max-per-host', type=int, dest="pool_max_per_host", default=8,
+                        help="Idle keep-alive origin connections kept per host:port [default: 8]")
+    parser.add_argument('--pool-idle-timeout', type=float, dest="pool_idle_timeout", default=30.0,
+                        help="Seconds an idle origin connection is kept [default: 30]")
+    util.add_proxy_arguments(parser)
+    args = parser.parse_args()
+
+    util.check_proxy_arguments(parser, args)
+
+    if not args.pidfile:
+        args.pidfile = f"/tmp/{__NAME__.lower()}.pid"
+
+    return args
+
+
+def main():
+    args = usage()
+    util.run_main(args, lambda dns, upstream, proxy_metrics, limits: HttpProxy(
+        args.host, args.port, args.relay, dns, upstream,
+        ConnectionPool(args.pool_max_idle, args.pool_max_per_host, args.pool_idle_timeout), proxy_metrics, limits))
+
+
+if __name__ == '__main__':
+    main()
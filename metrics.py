@@ -0,0 +1,228 @@
+import bisect
+import asyncio
+import logging
+
+logger = logging.getLogger('zzapp')
+
+# Seconds, covers loopback handshakes up to slow upstream connects.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    # Label values can come from clients (e.g. usernames).
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, value=1, label=None):
+        self.values[label] = self.values.get(label, 0) + value
+
+    def samples(self):
+        if not self.values and self.label is None:
+            yield self.name, 0
+        for label, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            yield self.name + _labels([(self.label, label)] if self.label else None), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, value=1, label=None):
+        self.inc(-value, label)
+
+
+class GaugeFunc:
+    """Gauge read from `callback()` at scrape time, which returns {label value: value}."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, label, callback):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.callback = callback
+
+    def samples(self):
+        for label, value in self.callback().items():
+            yield self.name + _labels([(self.label, label)] if self.label else None), value
+
+
+class CounterFunc(GaugeFunc):
+    """Counter read from `callback()` at scrape time, its values must never go down."""
+    kind = 'counter'
+
+
+def stat_metrics(name, help, callback, gauges):
+    """
+    Export a component's stats() dict: the `gauges` keys (levels such as a cache size) as GaugeFunc
+    `name`, everything else (event counts) as CounterFunc `name`_total, both labelled by 'stat'.
+    """
+    keys = callback().keys()
+    metrics = []
+    if keys & gauges:
+        metrics.append(GaugeFunc(name, help, 'stat',
+                                 lambda: {k: v for k, v in callback().items() if k in gauges}))
+    if keys - gauges:
+        metrics.append(CounterFunc(f'{name}_total', help, 'stat',
+                                   lambda: {k: v for k, v in callback().items() if k not in gauges}))
+    return metrics
+
+
+class Traffic:
+    """Bytes relayed by one live tunnel or HTTP request, kept up to date by the pipes: [upstream, downstream]."""
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = [0, 0]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', total
+        total += self.counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}}', total
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', total
+
+
+class ProxyMetrics:
+    """
+    Metrics shared by the SOCKS5 and HTTP proxies, exposed in the Prometheus text format
+    on http://host:port/metrics. A proxy without a ProxyMetrics records nothing.
+    """
+
+    def __init__(self, host='127.0.0.1', port=9100, prefix='zzproxy'):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.metrics = []
+
+        self.connections_active = self.add(Gauge(f'{prefix}_connections_active', 'Client connections open'))
+        self.connections_total = self.add(Counter(f'{prefix}_connections_total', 'Client connections accepted'))
+        # Live tunnels and UDP associations are summed at scrape time, so long ones show up as they go.
+        self.tunnels = set()
+        self.associations = set()
+        self._relayed = [0, 0]  # Bytes of the tunnels that ended
+        self.relayed_bytes = self.add(CounterFunc(
+            f'{prefix}_relayed_bytes_total', 'Bytes relayed through tunnels and HTTP requests', 'direction',
+            self.relayed))
+        self.handshake_seconds = self.add(Histogram(
+            f'{prefix}_handshake_seconds', 'Time from accept until the SOCKS5 request was read'))
+        self.auth_seconds = self.add(Histogram(f'{prefix}_auth_seconds', 'SOCKS5 username/password exchange time'))
+        self.dns_seconds = self.add(Histogram(f'{prefix}_dns_seconds', 'CONNECT target resolution time'))
+        self.connect_seconds = self.add(Histogram(f'{prefix}_connect_seconds', 'Upstream connect time'))
+        self.connect_failures = self.add(Counter(f'{prefix}_connect_failures_total', 'Failed upstream connects'))
+        self.socks_replies = self.add(Counter(f'{prefix}_socks_replies_total', 'SOCKS5 replies sent by REP code', 'rep'))
+        self._datagrams = [0, 0, 0]  # Sent, received and dropped by the associations that ended
+        self.udp_datagrams = self.add(CounterFunc(
+            f'{prefix}_udp_datagrams_total', 'Datagrams relayed by UDP associations', 'direction',
+            lambda: dict(zip(('upstream', 'downstream'), self.datagrams()))))
+        self.udp_dropped = self.add(CounterFunc(
+            f'{prefix}_udp_dropped_total', 'Datagrams dropped by UDP associations (malformed, unknown peer, errors)',
+            None, lambda: {None: self.datagrams()[2]}))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def tunnel_opened(self):
+        """A Traffic for the pipes of a new tunnel or HTTP request, hand it back to tunnel_closed()."""
+        traffic = Traffic()
+        self.tunnels.add(traffic)
+        return traffic
+
+    def tunnel_closed(self, traffic):
+        self.tunnels.discard(traffic)
+        self._relayed[0] += traffic.counts[0]
+        self._relayed[1] += traffic.counts[1]
+
+    def relayed(self):
+        upstream, downstream = self._relayed
+        for traffic in self.tunnels:
+            upstream += traffic.counts[0]
+            downstream += traffic.counts[1]
+        return {'upstream': upstream, 'downstream': downstream}
+
+    def association_opened(self, association):
+        """`association` is a udp.Association, its sent/received/dropped are read until association_closed()."""
+        self.associations.add(association)
+
+    def association_closed(self, association):
+        self.associations.discard(association)
+        self._datagrams[0] += association.sent
+        self._datagrams[1] += association.received
+        self._datagrams[2] += association.dropped
+
+    def datagrams(self):
+        """(sent, received, dropped) of all UDP associations so far."""
+        sent, received, dropped = self._datagrams
+        for association in self.associations:
+            sent += association.sent
+            received += association.received
+            dropped += association.dropped
+        return sent, received, dropped
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    async def start(self, reuse_port=False):
+        self.server = await asyncio.start_server(self.handle_scrape, self.host, self.port, reuse_port=reuse_port)
+        addr = self.server.sockets[0].getsockname()
+        logger.info("Serving metrics on http://%s:%s/metrics", addr[0], addr[1])
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def handle_scrape(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            parts = request.split(b' ', 2)
+            if len(parts) == 3 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = self.render().encode()
+                status = b'200 OK'
+            else:
+                body = b'Not Found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body)) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
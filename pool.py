@@ -0,0 +1,130 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+import relay
+
+logger = logging.getLogger('zzapp')
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive upstream connections, keyed by (host, port).
+    At most `max_per_host` idle connections per key and `max_idle` in total are kept,
+    each for up to `idle_timeout` seconds. max_idle=0 disables pooling.
+    """
+
+    def __init__(self, max_idle=256, max_per_host=8, idle_timeout=30.0):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = OrderedDict()  # key -> deque of (idle since, reader, writer), least recently used key first
+        self._count = 0
+        self._sweeper = None
+
+        self.hits = 0
+        self.misses = 0
+        self.released = 0
+        self.discarded = 0
+        self.expired = 0
+        self.unhealthy = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'idle': self._count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'released': self.released,
+            'discarded': self.discarded,
+            'expired': self.expired,
+            'unhealthy': self.unhealthy,
+        }
+
+    def acquire(self, key):
+        """Pop a healthy idle connection for `key`, most recently used first. Returns (reader, writer) or None."""
+        conns = self._idle.get(key)
+        deadline = time.monotonic() - self.idle_timeout
+        while conns:
+            since, reader, writer = conns.pop()
+            self._count -= 1
+            if since < deadline:
+                self.expired += 1
+                writer.close()
+            elif not self.healthy(reader, writer):
+                self.unhealthy += 1
+                writer.close()
+            else:
+                if not conns:
+                    del self._idle[key]
+                self.hits += 1
+                return reader, writer
+        self._idle.pop(key, None)
+        self.misses += 1
+        return None
+
+    def release(self, key, reader, writer):
+        """Park a connection whose last response was read completely."""
+        if self.max_idle <= 0 or self.max_per_host <= 0 or not self.healthy(reader, writer):
+            self.discarded += 1
+            writer.close()
+            return
+
+        conns = self._idle.get(key)
+        if conns is None:
+            conns = self._idle[key] = deque()
+        elif len(conns) >= self.max_per_host:
+            self.discarded += 1
+            conns.popleft()[2].close()
+            self._count -= 1
+        self._idle.move_to_end(key)
+        conns.append((time.monotonic(), reader, writer))
+        self._count += 1
+        self.released += 1
+
+        while self._count > self.max_idle:
+            self._evict_oldest()
+
+        if self._sweeper is None:
+            self._sweeper = asyncio.get_running_loop().call_later(self.idle_timeout, self._sweep)
+
+    def close(self):
+        for conns in self._idle.values():
+            for _, _, writer in conns:
+                writer.close()
+        self._idle.clear()
+        self._count = 0
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    @staticmethod
+    def healthy(reader, writer):
+        # Anything the origin sent while idle (data, EOF, RST) makes the connection unusable.
+        # Without access to the reader's buffer that can not be ruled out, so nothing is pooled.
+        buffer = relay.reader_buffer(reader)
+        return not (writer.is_closing() or reader.at_eof() or reader.exception() or buffer is None or buffer)
+
+    def _evict_oldest(self):
+        key, conns = next(iter(self._idle.items()))
+        conns.popleft()[2].close()
+        self._count -= 1
+        self.discarded += 1
+        if not conns:
+            del self._idle[key]
+
+    def _sweep(self):
+        self._sweeper = None
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self._idle):
+            conns = self._idle[key]
+            while conns and conns[0][0] < deadline:
+                conns.popleft()[2].close()
+                self._count -= 1
+                self.expired += 1
+            if not conns:
+                del self._idle[key]
+        if self._count:
+            self._sweeper = asyncio.get_running_loop().call_later(self.idle_timeout / 2, self._sweep)
@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import resource
+
+logger = logging.getLogger('zzapp')
+
+# 'stream' is the StreamReader/StreamWriter loop in Socks5Proxy.pipe; the other
+# engines take the sockets away from their transports and move bytes directly.
+ENGINES = ('auto', 'splice', 'sock', 'stream')
+
+BUFFER_SIZE = 1 << 16
+HAS_SPLICE = sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+# Descriptors per tunnel: 'sock' dup()s both sockets (the originals are closed right away),
+# 'splice' also keeps an os.pipe() per direction, 6 instead of 2. Tunnels whose sockets got a
+# descriptor in the top FD_RESERVE of RLIMIT_NOFILE use 'sock' so the extra pipes never starve accept().
+FD_RESERVE = 1 / 8
+
+
+def reader_buffer(reader):
+    """
+    The bytearray holding what a StreamReader has read from its transport but not returned yet
+    (clearing it consumes the bytes), or None when this asyncio keeps it some other way.
+    """
+    buffer = getattr(reader, '_buffer', None)
+    return buffer if isinstance(buffer, bytearray) else None
+
+
+def select_engine(engine, reader1, writer1, reader2, writer2):
+    """
+    Pick the relay engine for one tunnel.
+    Falls back to 'stream' whenever a transport can not be safely detached
+    (TLS, no real socket, bytes still queued for writing, or no access to what
+    the reader buffered), and from 'splice' to 'sock' close to the fd limit.
+    """
+    if engine == 'stream':
+        return 'stream'
+
+    highest_fd = 0
+    for reader, writer in ((reader1, writer1), (reader2, writer2)):
+        transport = writer.transport
+        if transport.is_closing():
+            return 'stream'
+        if transport.get_extra_info('sslcontext') is not None:
+            return 'stream'
+        sock = transport.get_extra_info('socket')
+        if sock is None:
+            return 'stream'
+        if transport.get_write_buffer_size():
+            return 'stream'
+        if reader_buffer(reader) is None:
+            return 'stream'
+        highest_fd = max(highest_fd, sock.fileno())
+
+    if engine == 'auto':
+        engine = 'splice' if HAS_SPLICE else 'sock'
+    if engine == 'splice' and (not HAS_SPLICE or near_fd_limit(highest_fd)):
+        return 'sock'
+    return engine
+
+
+def near_fd_limit(fd):
+    # New descriptors get the lowest free number, so every one below `fd` was in use when it was opened.
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return soft != resource.RLIM_INFINITY and fd >= soft - soft * FD_RESERVE
+
+
+def detach(reader, writer):
+    """
+    Take the socket out of a stream pair.
+    Returns a non-blocking duplicate of the socket and whatever the StreamReader
+    had already buffered, the original transport is closed.
+    """
+    transport = writer.transport
+    transport.pause_reading()
+    # Bytes already pulled off the socket (e.g. an eager TLS ClientHello or a
+    # server banner) have to go out before anything read from the raw socket.
+    buffer = reader_buffer(reader)
+    pending = bytes(buffer)
+    buffer.clear()
+
+    sock = transport.get_extra_info('socket').dup()
+    sock.setblocking(False)
+    transport.close()
+    return sock, pending
+
+
+async def wait_active(tasks, activity, idle_timeout, return_when):
+    """
+    asyncio.wait() that gives up once nothing was relayed for `idle_timeout` seconds.
+    `activity[0]` is the time.monotonic() of the last transfer, kept up to date by the pipes.
+    Returns False when the tunnel went idle.
+    """
+    if not idle_timeout:
+        await asyncio.wait(tasks, return_when=return_when)
+        return True
+    while True:
+        remaining = activity[0] + idle_timeout - time.monotonic()
+        if remaining <= 0:
+            return False
+        done, pending = await asyncio.wait(tasks, timeout=remaining, return_when=return_when)
+        if not pending or (done and return_when == asyncio.FIRST_COMPLETED):
+            return True
+
+
+async def relay(reader1, writer1, reader2, writer2, engine, peer1, peer2, idle_timeout=0, shapers=(None, None),
+                counts=None):
+    """
+    Relay until either side is done or nothing moved for `idle_timeout` seconds.
+    `shapers` are optional TokenBuckets limiting each direction in bytes/s.
+    `counts` ([1 to 2, 2 to 1]) gets the bytes added as they are sent, e.g. a metrics.Traffic's.
+    Returns the bytes sent (1 to 2, 2 to 1) and whether the tunnel timed out idle.
+    """
+    sock1, pending1 = detach(reader1, writer1)
+    try:
+        sock2, pending2 = detach(reader2, writer2)
+    except Exception:
+        sock1.close()
+        raise
+
+    pipe = _splice_pipe if engine == 'splice' else _sock_pipe
+    loop = asyncio.get_running_loop()
+    if counts is None:
+        counts = [0, 0]
+    activity = [time.monotonic()] if idle_timeout else None
+    tasks = [
+        loop.create_task(_run(pipe, loop, sock1, sock2, pending1, counts, 0, activity, shapers[0], peer1, peer2),
+                         name=f"relay_{peer1}_to_{peer2}"),
+        loop.create_task(_run(pipe, loop, sock2, sock1, pending2, counts, 1, activity, shapers[1], peer2, peer1),
+                         name=f"relay_{peer2}_to_{peer1}"),
+    ]
+    try:
+        # Same semantics as the stream path: once either side is done the tunnel is torn down.
+        active = await wait_active(tasks, activity, idle_timeout, asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        sock1.close()
+        sock2.close()
+    return counts[0], counts[1], not active
+
+
+async def _run(pipe, loop, src, dst, pending, counts, index, activity, shaper, source_peer, dest_peer):
+    try:
+        await pipe(loop, src, dst, pending, counts, index, activity, shaper)
+    except asyncio.CancelledError:
+        raise
+    except (ConnectionResetError, BrokenPipeError):
+        logger.debug("Connection reset/broken from %s to %s.", source_peer, dest_peer)
+    except Exception as e:
+        logger.error("Relay error from %s to %s: %s", source_peer, dest_peer, e, exc_info=True)
+
+
+async def _sock_pipe(loop, src, dst, pending, counts, index, activity, shaper):
+    if pending:
+        await loop.sock_sendall(dst, pending)
+        counts[index] += len(pending)
+
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = await loop.sock_recv_into(src, buf)
+        if not n:
+            break
+        await loop.sock_sendall(dst, view[:n])
+        counts[index] += n
+        if activity is not None:
+            activity[0] = time.monotonic()
+        if shaper is not None:
+            await _throttle(shaper, n)
+
+
+async def _splice_pipe(loop, src, dst, pending, counts, index, activity, shaper):
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    pipe_r, pipe_w = os.pipe()
+    try:
+        if pending:
+            await loop.sock_sendall(dst, pending)
+            counts[index] += len(pending)
+
+        while True:
+            try:
+                n = os.splice(src_fd, pipe_w, BUFFER_SIZE, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop.add_reader, loop.remove_reader, src_fd)
+                continue
+            if not n:
+                break
+            if activity is not None:
+                activity[0] = time.monotonic()
+
+            # The pipe is always drained before the next splice in, so it never fills up.
+            while n:
+                try:
+                    sent = os.splice(pipe_r, dst_fd, n, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop.add_writer, loop.remove_writer, dst_fd)
+                    continue
+                n -= sent
+                counts[index] += sent
+                if shaper is not None:
+                    await _throttle(shaper, sent)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+async def _throttle(shaper, n):
+    delay = shaper.take(n)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+async def _wait_fd(add, remove, fd):
+    fut = asyncio.get_running_loop().create_future()
+    add(fd, _wake, fut)
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
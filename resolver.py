@@ -0,0 +1,130 @@
+import time
+import socket
+import asyncio
+import logging
+import ipaddress
+from collections import OrderedDict
+
+logger = logging.getLogger('zzapp')
+
+PREFERENCES = ('any', 'ipv4', 'ipv6')
+
+
+class Resolver:
+    """
+    Caching resolver for CONNECT targets.
+    Answers are kept in a bounded LRU for `ttl` seconds, failures for `negative_ttl`
+    seconds, and concurrent lookups of the same name share one getaddrinfo call.
+
+    :param getaddrinfo: coroutine function with the signature of loop.getaddrinfo,
+                        defaults to the running loop's (thread pool backed) one
+    """
+
+    def __init__(self, ttl=60.0, negative_ttl=10.0, max_size=4096, prefer='any', getaddrinfo=None):
+        if prefer not in PREFERENCES:
+            raise ValueError(f"prefer must be one of {PREFERENCES}")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.prefer = prefer
+        self._getaddrinfo = getaddrinfo
+        self._cache = OrderedDict()  # host -> (expires, addresses | (errno, strerror))
+        self._inflight = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+        }
+
+    async def resolve(self, host):
+        """
+        Resolve `host` to a list of IP address strings, preferred family first.
+        Raises socket.gaierror when the name does not resolve.
+        """
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+
+        host = host.lower()
+        entry = self._cache.get(host)
+        if entry is not None:
+            expires, result = entry
+            if expires > time.monotonic():
+                self._cache.move_to_end(host)
+                if isinstance(result, tuple):
+                    self.negative_hits += 1
+                    raise socket.gaierror(*result)
+                self.hits += 1
+                return result
+            del self._cache[host]
+
+        task = self._inflight.get(host)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._lookup(host), name=f"resolve_{host}")
+            self._inflight[host] = task
+            task.add_done_callback(lambda t: self._lookup_done(host, t))
+        else:
+            self.coalesced += 1
+        # shield: a client giving up must not cancel a lookup other clients wait on.
+        return await asyncio.shield(task)
+
+    async def _lookup(self, host):
+        getaddrinfo = self._getaddrinfo or asyncio.get_running_loop().getaddrinfo
+        try:
+            infos = await getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            self.errors += 1
+            logger.debug("Resolve %s failed: %s", host, e)
+            self._store(host, (e.errno, e.strerror), self.negative_ttl)
+            raise
+
+        seen = set()
+        candidates = []
+        for family, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in seen:
+                seen.add(sockaddr[0])
+                candidates.append((family, sockaddr[0]))
+        addresses = [addr for _, addr in sorted(candidates, key=self._preference)]
+        if not addresses:
+            self.errors += 1
+            self._store(host, (socket.EAI_NONAME, 'No address associated with hostname'), self.negative_ttl)
+            raise socket.gaierror(socket.EAI_NONAME, 'No address associated with hostname')
+
+        self._store(host, addresses, self.ttl)
+        return addresses
+
+    def _preference(self, item):
+        family = item[0]
+        if self.prefer == 'ipv4':
+            return family != socket.AF_INET
+        if self.prefer == 'ipv6':
+            return family != socket.AF_INET6
+        return False
+
+    def _store(self, host, result, ttl):
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._cache[host] = (time.monotonic() + ttl, result)
+        self._cache.move_to_end(host)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _lookup_done(self, host, task):
+        self._inflight.pop(host, None)
+        # Retrieve the exception so a lookup nobody waits on anymore is not reported as unhandled.
+        if not task.cancelled():
+            task.exception()
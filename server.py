@@ -0,0 +1,114 @@
+import abc
+import time
+import signal
+import asyncio
+import logging
+
+import util
+import resolver
+import dialer
+import metrics
+import admission
+
+logger = logging.getLogger('zzapp')
+
+# stats() keys that are levels rather than event counts, exported as gauges instead of counters.
+GAUGE_STATS = frozenset(('size', 'active', 'idle', 'hit_rate', 'users', 'cached'))
+
+
+class ProxyServer(abc.ABC):
+    """
+    What the SOCKS5 and HTTP proxies share: the listening server, metrics and SIGUSR1 stats,
+    draining for workers.serve_worker, and dialing upstream targets. Subclasses implement
+    handle_client(reader, writer) and keep their client tasks in `clients`.
+    """
+    protocol = None  # Shown in the "Serving ..." log line
+
+    def __init__(self, host, port, relay_engine='auto', dns=None, upstream=None, metrics=None, limits=None):
+        self.host = host
+        self.port = port
+        self.relay_engine = relay_engine
+        self.dns = dns or resolver.Resolver()
+        self.upstream = upstream or dialer.Dialer()
+        self.metrics = metrics
+        self.limits = limits or admission.Admission()
+        self.server = None
+        self.clients = set()
+
+    def stat_sources(self):
+        """(metric name suffix, description, callback returning {stat: value}), logged and exported."""
+        return [
+            ('dns_cache', 'DNS cache', self.dns.stats),
+            ('admission', 'Admission control', self.limits.stats),
+            ('log', 'Log queue', util.log_stats),
+        ]
+
+    def signal_handlers(self, reuse_port):
+        """{signal: callback} installed on the event loop, `reuse_port` is True under workers.serve_worker."""
+        return {signal.SIGUSR1: self.log_stats}
+
+    async def start(self, reuse_port=False):
+        self.server = server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, reuse_port=reuse_port
+        )
+        addr = server.sockets[0].getsockname()
+        logger.info("Serving %s on %s:%s", self.protocol, addr[0], addr[1])
+
+        if self.metrics:
+            self.register_metrics(self.metrics)
+            await self.metrics.start(reuse_port)
+
+        loop = asyncio.get_running_loop()
+        for sig, callback in self.signal_handlers(reuse_port).items():
+            try:
+                loop.add_signal_handler(sig, callback)
+            except (AttributeError, NotImplementedError):  # No such signal on this platform
+                pass
+
+        async with server:
+            await server.serve_forever()
+
+    def register_metrics(self, proxy_metrics):
+        for name, description, callback in self.stat_sources():
+            for metric in metrics.stat_metrics(f'zzproxy_{name}', description, callback, GAUGE_STATS):
+                proxy_metrics.add(metric)
+
+    def log_stats(self):
+        stats = ', '.join(f"{description}: " + ' '.join(f"{k}={v}" for k, v in callback().items())
+                          for _, description, callback in self.stat_sources())
+        logger.info("Connections: %s, %s", len(self.clients), stats)
+
+    async def drain(self, timeout):
+        # Stop accepting, give in-flight clients `timeout` seconds to finish, then cut them.
+        if self.server:
+            self.server.close()
+        if self.metrics:
+            self.metrics.close()
+        if not self.clients:
+            return
+        logger.info("Draining %s connection(s), timeout %ss", len(self.clients), timeout)
+        _, pending = await asyncio.wait(self.clients, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def dial(self, host, port):
+        m = self.metrics
+        if not m:
+            return await self.upstream.dial(await self.dns.resolve(host), port)
+
+        started = time.monotonic()
+        addresses = await self.dns.resolve(host)
+        resolved = time.monotonic()
+        m.dns_seconds.observe(resolved - started)
+        try:
+            conn = await self.upstream.dial(addresses, port)
+        except Exception:
+            m.connect_failures.inc()
+            raise
+        m.connect_seconds.observe(time.monotonic() - resolved)
+        return conn
+
+    @abc.abstractmethod
+    async def handle_client(self, reader, writer):
+        """Serve one accepted connection."""
@@ -1,115 +1,191 @@
 #!/usr/bin/env python3
 
-import sys
+import os
+import time
+import signal
 import asyncio
 import logging
 import socket
 import struct
 import argparse
-import daemon
-from daemon import pidfile
 
 import util
+import relay
+import dialer
+import metrics
+import credentials
+import udp
+from server import ProxyServer
 
 __NAME__ = 'ZZSocks5Proxy'
 __VERSION__ = "1.0"
 
 logger = logging.getLogger('zzapp')
-
-
-class Socks5Proxy:
-    def __init__(self, host, port, user=None, password=None):
-        self.host = host
-        self.port = port
-        self.user = user
-        self.password = password
-
-    async def start(self):
-        server = await asyncio.start_server(
-            self.handle_client, self.host, self.port
-        )
-        addr = server.sockets[0].getsockname()
-        logger.info(f"Serving SOCKS5 on {addr[0]}:{addr[1]}")
-
-        async with server:
-            await server.serve_forever()
+# One line per tunnel/request, can be sampled with --access-log-sample.
+access_logger = logging.getLogger('zzapp.access')
+
+
+class Socks5Proxy(ProxyServer):
+    protocol = 'SOCKS5'
+
+    def __init__(self, host, port, user=None, password=None, relay_engine='auto', dns=None, upstream=None,
+                 metrics=None, limits=None, store=None, udp_timeout=60.0):
+        super().__init__(host, port, relay_engine, dns, upstream, metrics, limits)
+        # `store` (a credentials.CredentialStore) takes precedence over the single user/password pair.
+        if store is None and user and password:
+            store = credentials.StaticCredentials(user, password)
+        self.credentials = store
+        self.udp_timeout = udp_timeout
+
+    def stat_sources(self):
+        sources = super().stat_sources()
+        if self.credentials:
+            sources.append(('auth', 'Credential store', self.credentials.stats))
+        return sources
+
+    def register_metrics(self, proxy_metrics):
+        super().register_metrics(proxy_metrics)
+        if self.credentials:
+            proxy_metrics.add(metrics.CounterFunc(
+                'zzproxy_auth_successes_total', 'Successful logins per user', 'user', self.credentials.successes.copy))
+            proxy_metrics.add(metrics.CounterFunc(
+                'zzproxy_auth_failures_total', 'Failed logins per user, unknown users as ""', 'user',
+                self.credentials.failures.copy))
+
+    def signal_handlers(self, reuse_port):
+        handlers = super().signal_handlers(reuse_port)
+        # Under workers.serve_worker (reuse_port) SIGHUP means drain, and the supervisor's SIGHUP
+        # starts fresh workers that load the credentials anew.
+        if self.credentials and self.credentials.reloadable and not reuse_port:
+            handlers[signal.SIGHUP] = self.credentials.reload
+        return handlers
 
     async def handle_client(self, reader, writer):
-        addr = ':'.join([str(x) for x in writer.get_extra_info('peername')])
-        logger.debug(f"Accepted connection from {addr}")
+        peername = writer.get_extra_info('peername')
+        addr = ':'.join([str(x) for x in peername])
+        limits = self.limits
+        rejected = limits.admit(peername[0])
+        if rejected:
+            # There is no SOCKS5 reply before method selection, just hang up.
+            logger.debug("Rejected connection from %s (%s limit)", addr, rejected)
+            writer.transport.abort()
+            return
+        logger.debug("Accepted connection from %s", addr)
+        task = asyncio.current_task()
+        self.clients.add(task)
+        m = self.metrics
+        if m:
+            accepted = time.monotonic()
+            m.connections_total.inc()
+            m.connections_active.inc()
 
         try:
-            # SOCKS5 Handshake
-            version, nmethods = await reader.readexactly(2)
-            if version != 5:
-                logger.warning(f"Unsupported SOCKS version {version} from {addr}")
-                return
-            methods = await reader.readexactly(nmethods)
-
-            auth_method = 0xFF  # No acceptable methods
-            if self.user and self.password:
-                auth_method = 2  # Username/Password Authentication
-            elif 0 in methods:
-                auth_method = 0  # No Authentication Required
-
-            writer.write(struct.pack('!BB', 5, auth_method))
-            await writer.drain()
-
-            if auth_method == 0xFF:
-                logger.warning(f"No acceptable authentication methods for {addr}.")
-                return
-
-            if auth_method == 2:
-                if not await self.authenticate(reader, writer, addr):
-                    return
-
-            # SOCKS5 Request
-            version, cmd, rsv, atyp = await reader.readexactly(4)
-            if version != 5 or rsv != 0:
-                logger.warning(f"Malformed SOCKS request from {addr}")
+            try:
+                async with asyncio.timeout(limits.handshake_timeout):
+                    request = await self.negotiate(reader, writer, addr)
+            except TimeoutError:
+                limits.handshake_timeouts += 1
+                logger.warning("Handshake timeout for %s.", addr)
                 return
-
-            if atyp == 1:  # IPv4
-                dest_addr_raw = await reader.readexactly(4)
-                dest_addr = socket.inet_ntoa(dest_addr_raw)
-            elif atyp == 3:  # Domain name
-                domain_len = await reader.readexactly(1)
-                dest_addr_raw = await reader.readexactly(domain_len[0])
-                dest_addr = dest_addr_raw.decode('utf-8')
-            elif atyp == 4:  # IPv6
-                dest_addr_raw = await reader.readexactly(16)
-                dest_addr = socket.inet_ntop(socket.AF_INET6, dest_addr_raw)
-            else:
-                logger.warning(f"Unsupported address type {atyp} from {addr}")
+            if request is None:
                 return
-
-            dest_port_raw = await reader.readexactly(2)
-            dest_port = struct.unpack('!H', dest_port_raw)[0]
+            cmd, dest_addr, dest_port = request
+            if m:
+                m.handshake_seconds.observe(time.monotonic() - accepted)
 
             if cmd == 1:  # CONNECT
                 await self.handle_connect(reader, writer, addr, dest_addr, dest_port)
+            elif cmd == 3:  # UDP ASSOCIATE
+                await self.handle_udp_associate(reader, writer, addr, dest_addr, dest_port)
             else:
-                logger.warning(f"Unsupported command {cmd} from {addr}")
+                logger.warning("Unsupported command %s from %s", cmd, addr)
                 # Send failure response
                 writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')  # Command not supported
                 await writer.drain()
+                if m:
+                    m.socks_replies.inc(label='0x07')
                 return
 
         except asyncio.IncompleteReadError:
-            logger.warning(f"Client {addr} disconnected unexpectedly.")
+            logger.warning("Client %s disconnected unexpectedly.", addr)
         except Exception as e:
-            logger.error(f"Error handling client {addr}: {e}", exc_info=True)
+            logger.error("Error handling client %s: %s", addr, e, exc_info=True)
         finally:
+            self.clients.discard(task)
+            limits.release(peername[0])
+            if m:
+                m.connections_active.dec()
             if not writer.is_closing():
                 writer.close()
                 await writer.wait_closed()
-            logger.debug(f"Connection to {addr} is fully closed.")
+            logger.debug("Connection to %s is fully closed.", addr)
+
+    async def negotiate(self, reader, writer, addr):
+        """Method selection, authentication and the request. Returns (cmd, dest_addr, dest_port) or None."""
+        version, nmethods = await reader.readexactly(2)
+        if version != 5:
+            logger.warning("Unsupported SOCKS version %s from %s", version, addr)
+            return None
+        methods = await reader.readexactly(nmethods)
+
+        auth_method = 0xFF  # No acceptable methods
+        if self.credentials:
+            auth_method = 2  # Username/Password Authentication
+        elif 0 in methods:
+            auth_method = 0  # No Authentication Required
+
+        writer.write(struct.pack('!BB', 5, auth_method))
+        await writer.drain()
+
+        if auth_method == 0xFF:
+            logger.warning("No acceptable authentication methods for %s.", addr)
+            return None
+
+        if auth_method == 2:
+            m = self.metrics
+            if m:
+                auth_started = time.monotonic()
+            try:
+                async with asyncio.timeout(self.limits.auth_timeout):
+                    authenticated = await self.authenticate(reader, writer, addr)
+            except TimeoutError:
+                self.limits.auth_timeouts += 1
+                logger.warning("Authentication timeout for %s.", addr)
+                return None
+            if m:
+                m.auth_seconds.observe(time.monotonic() - auth_started)
+            if not authenticated:
+                return None
+
+        # SOCKS5 Request
+        version, cmd, rsv, atyp = await reader.readexactly(4)
+        if version != 5 or rsv != 0:
+            logger.warning("Malformed SOCKS request from %s", addr)
+            return None
+
+        if atyp == 1:  # IPv4
+            dest_addr_raw = await reader.readexactly(4)
+            dest_addr = socket.inet_ntoa(dest_addr_raw)
+        elif atyp == 3:  # Domain name
+            domain_len = await reader.readexactly(1)
+            dest_addr_raw = await reader.readexactly(domain_len[0])
+            dest_addr = dest_addr_raw.decode('utf-8')
+        elif atyp == 4:  # IPv6
+            dest_addr_raw = await reader.readexactly(16)
+            dest_addr = socket.inet_ntop(socket.AF_INET6, dest_addr_raw)
+        else:
+            logger.warning("Unsupported address type %s from %s", atyp, addr)
+            return None
+
+        dest_port_raw = await reader.readexactly(2)
+        dest_port = struct.unpack('!H', dest_port_raw)[0]
+        return cmd, dest_addr, dest_port
 
     async def authenticate(self, reader, writer, addr):
         try:
             ver = await reader.readexactly(1)
             if ver[0] != 1:
-                logger.warning(f"Invalid auth version from {addr}")
+                logger.warning("Invalid auth version from %s", addr)
                 return False
 
             ulen = await reader.readexactly(1)
@@ -118,53 +194,137 @@ class Socks5Proxy:
             plen = await reader.readexactly(1)
             password = (await reader.readexactly(plen[0])).decode('utf-8')
 
-            if user == self.user and password == self.password:
+            if await self.credentials.verify(user, password):
                 writer.write(b'\x01\x00')  # Success
                 await writer.drain()
-                logger.info(f"Successful auth from {addr} for user '{user}'")
+                access_logger.info("Successful auth from %s for user '%s'", addr, user,
+                                   extra={'access': {'client': str(addr), 'user': user}})
                 return True
             else:
                 writer.write(b'\x01\x01')  # Failure
                 await writer.drain()
-                logger.warning(f"Failed auth from {addr} for user '{user}'")
+                logger.warning("Failed auth from %s for user '%s'", addr, user)
                 return False
         except asyncio.IncompleteReadError:
-            logger.warning(f"Client {addr} disconnected during authentication.")
+            logger.warning("Client %s disconnected during authentication.", addr)
             return False
 
     async def handle_connect(self, client_reader, client_writer, client_addr, dest_addr, dest_port):
-        logger.info(f"[{client_addr}] CONNECT request to {dest_addr}:{dest_port}")
+        access_logger.info("[%s] CONNECT request to %s:%s", client_addr, dest_addr, dest_port,
+                           extra={'access': {'client': str(client_addr), 'method': 'CONNECT',
+                                             'target': f"{dest_addr}:{dest_port}"}})
+        m = self.metrics
         try:
-            upstream_reader, upstream_writer = await asyncio.open_connection(dest_addr, dest_port)
+            upstream_reader, upstream_writer = await self.dial(dest_addr, dest_port)
         except Exception as e:
-            logger.error(f"[{client_addr}] Failed to connect to {dest_addr}:{dest_port}: {e}")
+            rep = dialer.reply_code(e)
+            logger.error("[%s] Failed to connect to %s:%s: %s (REP %s)", client_addr, dest_addr, dest_port, e, rep)
             # Send failure response
-            client_writer.write(b'\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00')  # Host unreachable
+            client_writer.write(struct.pack('!BB', 5, rep) + b'\x00\x01\x00\x00\x00\x00\x00\x00')
             await client_writer.drain()
+            if m:
+                m.socks_replies.inc(label=f'0x{rep:02x}')
             return
 
         # Send success response
         # REP: 0x00 (succeeded), RSV: 0x00, ATYP: 0x01 (IPv4), BND.ADDR/BND.PORT: 0s
         client_writer.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
         await client_writer.drain()
+        if m:
+            m.socks_replies.inc(label='0x00')
 
-        await self.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer)
+        traffic = m.tunnel_opened() if m else None
+        try:
+            await self.pipe_bi(client_reader, client_writer, upstream_reader, upstream_writer, self.relay_engine,
+                               self.limits, traffic.counts if traffic else None)
+        finally:
+            if traffic:
+                m.tunnel_closed(traffic)
+
+    async def handle_udp_associate(self, client_reader, client_writer, client_addr, dest_addr, dest_port):
+        # DST.ADDR/DST.PORT is where the client will send from, often all zeros. Datagrams are only
+        # accepted from the address of the TCP connection, and DST.PORT when it was given.
+        access_logger.info("[%s] UDP ASSOCIATE from %s:%s", client_addr, dest_addr, dest_port,
+                           extra={'access': {'client': str(client_addr), 'method': 'UDP ASSOCIATE',
+                                             'target': f"{dest_addr}:{dest_port}"}})
+        m = self.metrics
+        client_ip = client_writer.get_extra_info('peername')[0]
+        association = udp.Association(client_ip, dest_port, self.dns.resolve, self.udp_timeout, self.dns.ttl)
+        try:
+            bind_addr, bind_port = await association.open(client_writer.get_extra_info('sockname')[0])
+        except OSError as e:
+            association.close()
+            logger.error("[%s] Failed to open UDP association: %s", client_addr, e)
+            client_writer.write(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')  # General failure
+            await client_writer.drain()
+            if m:
+                m.socks_replies.inc(label='0x01')
+            return
+
+        try:
+            if ':' in bind_addr:
+                bound = b'\x04' + socket.inet_pton(socket.AF_INET6, bind_addr)
+            else:
+                bound = b'\x01' + socket.inet_aton(bind_addr)
+            client_writer.write(b'\x05\x00\x00' + bound + struct.pack('!H', bind_port))
+            await client_writer.drain()
+            if m:
+                m.socks_replies.inc(label='0x00')
+                m.association_opened(association)
+            logger.debug("[%s] UDP relay on %s:%s", client_addr, bind_addr, bind_port)
+
+            # The association lives as long as the TCP connection, which carries nothing else.
+            idle_timeout = self.limits.idle_timeout
+            while True:
+                timeout = None
+                if idle_timeout:
+                    timeout = association.last_active + idle_timeout - asyncio.get_running_loop().time()
+                    if timeout <= 0:
+                        self.limits.idle_timeouts += 1
+                        logger.info("[%s] UDP association idle for %ss, closed.", client_addr, idle_timeout)
+                        break
+                try:
+                    async with asyncio.timeout(timeout):
+                        if not await client_reader.read(4096):
+                            break
+                except TimeoutError:
+                    pass
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            association.close()
+            logger.debug("[%s] UDP association closed: sent=%s received=%s dropped=%s",
+                         client_addr, association.sent, association.received, association.dropped)
+            if m:
+                m.association_closed(association)
 
     @staticmethod
-    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source_peer: str, dest_peer: str):
+    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source_peer: str, dest_peer: str,
+                   activity=None, shaper=None, counts=None, index=0):
+        """Copy until EOF, returns the bytes written. `counts[index]` (if given) is kept up to date as well."""
+        total = 0
         try:
             while True:
                 data = await reader.read(4096)
                 if not data:
                     break
                 writer.write(data)
+                total += len(data)
+                if counts is not None:
+                    counts[index] += len(data)
                 await writer.drain()
+                if activity is not None:
+                    activity[0] = time.monotonic()
+                if shaper is not None:
+                    delay = shaper.take(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
         except asyncio.CancelledError:
             raise
         except (ConnectionResetError, BrokenPipeError):
-            logger.debug(f"Connection reset/broken from {source_peer} to {dest_peer}.")
+            logger.debug("Connection reset/broken from %s to %s.", source_peer, dest_peer)
         except Exception as e:
-            logger.error(f"Pipe error from {source_peer} to {dest_peer}: {e}", exc_info=True)
+            logger.error("Pipe error from %s to %s: %s", source_peer, dest_peer, e, exc_info=True)
         finally:
             if not writer.is_closing():
                 writer.close()
@@ -172,18 +332,51 @@ class Socks5Proxy:
                     await writer.wait_closed()
                 except Exception:
                     pass
+        return total
 
     @staticmethod
-    async def pipe_bi(reader1, writer1, reader2, writer2):
+    async def pipe_bi(reader1, writer1, reader2, writer2, engine='stream', limits=None, counts=None):
+        """
+        Relay between two stream pairs, returns the bytes sent (1 to 2, 2 to 1).
+        `limits` (admission.Admission) supplies the idle timeout and bandwidth shaping.
+        `counts` ([1 to 2, 2 to 1], e.g. a metrics.Traffic's) gets the bytes added while they are relayed.
+        """
         peer1 = ':'.join([str(x) for x in writer1.get_extra_info('peername')])
         peer2 = ':'.join([str(x) for x in writer2.get_extra_info('peername')])
-        logger.debug(f"Piping data between {peer1} and {peer2}")
-
-        async with asyncio.TaskGroup() as tg:
-            tg.create_task(Socks5Proxy.pipe(reader1, writer2, peer1, peer2), name=f"pipe_{peer1}_to_{peer2}")
-            tg.create_task(Socks5Proxy.pipe(reader2, writer1, peer2, peer1), name=f"pipe_{peer2}_to_{peer1}")
-
-        logger.debug(f"Pipe between {peer1} and {peer2} finished.")
+        engine = relay.select_engine(engine, reader1, writer1, reader2, writer2)
+        logger.debug("Piping data between %s and %s (%s)", peer1, peer2, engine)
+        idle_timeout = limits.idle_timeout if limits else 0
+        shapers = (limits.shaper(), limits.shaper()) if limits else (None, None)
+
+        if engine == 'stream':
+            activity = [time.monotonic()] if idle_timeout else None
+            tasks = [
+                asyncio.create_task(Socks5Proxy.pipe(reader1, writer2, peer1, peer2, activity, shapers[0], counts, 0),
+                                    name=f"pipe_{peer1}_to_{peer2}"),
+                asyncio.create_task(Socks5Proxy.pipe(reader2, writer1, peer2, peer1, activity, shapers[1], counts, 1),
+                                    name=f"pipe_{peer2}_to_{peer1}"),
+            ]
+            try:
+                idle = not await relay.wait_active(tasks, activity, idle_timeout, asyncio.ALL_COMPLETED)
+                if idle:
+                    # Closing both transports ends the pipes with their byte counts.
+                    writer1.close()
+                    writer2.close()
+                    await asyncio.wait(tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            counts = tasks[0].result(), tasks[1].result()
+        else:
+            *counts, idle = await relay.relay(reader1, writer1, reader2, writer2, engine, peer1, peer2,
+                                              idle_timeout, shapers, counts)
+
+        if idle:
+            limits.idle_timeouts += 1
+            logger.info("Tunnel between %s and %s idle for %ss, closed.", peer1, peer2, idle_timeout)
+        logger.debug("Pipe between %s and %s finished.", peer1, peer2)
+        return tuple(counts)
 
 
 def usage():
@@ -196,21 +389,34 @@ def usage():
                         help="Username for authentication")
     parser.add_argument('-p', '--password', type=str, dest="password", default=None,
                         help="Password for authentication")
-    parser.add_argument('-l', '--logfile', type=str, dest="logfile", default='STDOUT',
-                        help="Path to the logfile [default: STDOUT]")
+    parser.add_argument('--udp-timeout', type=float, dest="udp_timeout", default=60.0,
+                        help="Seconds a UDP ASSOCIATE peer is remembered without traffic [default: 60]")
+    parser.add_argument('--htpasswd', type=str, dest="htpasswd", default=None,
+                        help="htpasswd-style file of users (pbkdf2-sha256, apr1, {SHA}, bcrypt), "
+                             "reloaded on SIGHUP or when it changes")
+    parser.add_argument('--auth-cache-ttl', type=float, dest="auth_cache_ttl", default=300.0,
+                        help="Seconds a verified --htpasswd login is cached [default: 300]")
+    parser.add_argument('--auth-threads', type=int, dest="auth_threads", default=4,
+                        help="Threads checking --htpasswd hashes, 0 checks on the event loop [default: 4]")
+    util.add_proxy_arguments(parser)
     parser.add_argument('--pidfile', type=str, dest="pidfile", default=None,
                         help=f"Path to the pidfile [default: /tmp/{__NAME__.lower()}.pid]")
-    parser.add_argument('-d', '--daemon', action='store_true', dest="daemon", default=False,
-                        help="Daemonize (run in the background). Daemon mode must specify logfile")
-    parser.add_argument('-v', '--verbose', action='store_true', dest="verbose", default=False,
-                        help="Log debug info")
     args = parser.parse_args()
 
     if (args.user and not args.password) or (not args.user and args.password):
         parser.error("Both --user and --password are required for authentication.")
 
-    if args.daemon and args.logfile in ('-', 'STDOUT'):
-        parser.error("Daemon mode requires a logfile path.")
+    if args.htpasswd:
+        if args.user:
+            parser.error("--htpasswd can not be combined with --user/--password.")
+        if not os.path.isfile(args.htpasswd):
+            parser.error(f"--htpasswd {args.htpasswd} is not a file.")
+        if args.auth_threads < 0:
+            parser.error("--auth-threads must be >= 0.")
+        # Daemon mode changes the working directory.
+        args.htpasswd = os.path.abspath(args.htpasswd)
+
+    util.check_proxy_arguments(parser, args)
 
     if not args.pidfile:
         args.pidfile = f"/tmp/{__NAME__.lower()}.pid"
@@ -220,38 +426,15 @@ def usage():
 
 def main():
     args = usage()
-    if not (0 < args.port < 65536):
-        print(f'Port[{args.port}] invalid', file=sys.stderr)
-        sys.exit(1)
-
-    logger = util.setup_logging(args.logfile, 20, args.verbose)
-
-    if args.daemon:
-        context = daemon.DaemonContext(
-            working_directory='/tmp',
-            umask=0o022,
-            pidfile=pidfile.TimeoutPIDLockFile(args.pidfile),
-            files_preserve=[handler.stream.fileno() for handler in logger.handlers],
-            stdout=logger.handlers[0].stream,
-            stderr=logger.handlers[0].stream,
-        )
-        try:
-            with context:
-                logger.info("Daemon process started.")
-                proxy = Socks5Proxy(args.host, args.port, args.user, args.password)
-                asyncio.run(proxy.start())
-        except Exception as e:
-            logger.critical(f"Daemon failed to start: {e}")
-            sys.exit(1)
-    else:
-        try:
-            logger.info("Starting proxy in foreground.")
-            proxy = Socks5Proxy(args.host, args.port, args.user, args.password)
-            asyncio.run(proxy.start())
-        except KeyboardInterrupt:
-            logger.info("Proxy stopped by user.")
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}", exc_info=True)
+
+    def make_proxy(dns, upstream, proxy_metrics, limits):
+        store = None
+        if args.htpasswd:
+            store = credentials.HtpasswdFile(args.htpasswd, args.auth_cache_ttl, args.auth_threads)
+        return Socks5Proxy(args.host, args.port, args.user, args.password, args.relay, dns, upstream,
+                           proxy_metrics, limits, store, args.udp_timeout)
+
+    util.run_main(args, make_proxy)
 
 
 if __name__ == '__main__':
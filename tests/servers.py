@@ -0,0 +1,91 @@
+"""Local servers the proxy tests run against."""
+
+import asyncio
+
+import httproxy
+
+
+class Origin:
+    """
+    HTTP/1.1 origin on 127.0.0.1. Every request head and body is recorded in `requests`,
+    `respond(head, body)` returns the raw response bytes (default: 200 with a short body).
+    Connections stay open until the client closes them or `close_after` responses were sent.
+    """
+
+    def __init__(self, respond=None, close_after=0):
+        self.respond = respond or (lambda head, body: ok(b'hello'))
+        self.close_after = close_after
+        self.requests = []
+        self.connections = 0
+        self.writers = set()
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    def drop_idle(self):
+        """Close every open connection from the origin side, like an expired keep-alive timeout."""
+        for writer in list(self.writers):
+            writer.close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        served = 0
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                headers = dict(line.split(': ', 1) for line in head.decode('latin-1').split('\r\n')[1:] if line)
+                body = await reader.readexactly(int(headers.get('Content-Length', 0)))
+                self.requests.append((head, body))
+                writer.write(self.respond(head, body))
+                await writer.drain()
+                served += 1
+                if self.close_after and served >= self.close_after:
+                    break
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+def ok(body, extra=b''):
+    return b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n%s' % (len(body), extra, body)
+
+
+async def start_proxy(proxy_class=httproxy.HttpProxy, **kwargs):
+    """A proxy (HttpProxy by default) serving on a free port, returns (proxy, port, serving task)."""
+    proxy = proxy_class('127.0.0.1', 0, **kwargs)
+    task = asyncio.create_task(proxy.start())
+    while proxy.server is None or not proxy.server.sockets:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return proxy, proxy.server.sockets[0].getsockname()[1], task
+
+
+async def stop_proxy(proxy, task):
+    await proxy.drain(1)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def request(port, data):
+    """Send raw bytes to the proxy, returns everything it answers until it closes the connection."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    try:
+        return await asyncio.wait_for(reader.read(-1), 5)
+    finally:
+        writer.close()
@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import Admission, TokenBucket
+from socks5 import Socks5Proxy
+from servers import start_proxy, stop_proxy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic() of the admission module, advanced by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_global_cap():
+    limits = Admission(max_connections=2)
+    assert [limits.admit(ip) for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3')] == [None, None, admission.GLOBAL]
+    limits.release('10.0.0.1')
+    assert limits.admit('10.0.0.3') is None
+    assert limits.stats()['active'] == 2
+    assert limits.stats()['admitted'] == 3 and limits.stats()['rejected_global'] == 1
+
+
+def test_per_ip_cap():
+    limits = Admission(max_per_ip=1)
+    assert [limits.admit(ip) for ip in ('10.0.0.1', '10.0.0.1', '10.0.0.2')] == [None, admission.PER_IP, None]
+    limits.release('10.0.0.1')
+    assert limits.admit('10.0.0.1') is None
+    assert limits.rejected == {admission.GLOBAL: 0, admission.PER_IP: 1, admission.RATE: 0}
+
+
+def admit_and_release(limits, ip):
+    reason = limits.admit(ip)
+    if reason is None:
+        limits.release(ip)
+    return reason
+
+
+def test_rate_bucket_burst_and_refill(clock):
+    limits = Admission(ip_rate=2, ip_burst=3)
+    assert [admit_and_release(limits, '10.0.0.1') for _ in range(4)] == [None, None, None, admission.RATE]
+    assert admit_and_release(limits, '10.0.0.2') is None  # Every IP has its own bucket
+    clock[0] += 0.5  # One token back at 2/s
+    assert [admit_and_release(limits, '10.0.0.1') for _ in range(2)] == [None, admission.RATE]
+    assert limits.rejected[admission.RATE] == 2
+
+
+def test_rate_burst_defaults_to_the_rate(clock):
+    limits = Admission(ip_rate=0.5)
+    assert [admit_and_release(limits, '10.0.0.1') for _ in range(2)] == [None, admission.RATE]
+
+
+def test_full_buckets_are_pruned(clock, monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_TRACKED', 2)
+    limits = Admission(ip_rate=1, ip_burst=2)
+    admit_and_release(limits, '10.0.0.1')
+    admit_and_release(limits, '10.0.0.2')
+    clock[0] += 1  # Both buckets are full again
+    admit_and_release(limits, '10.0.0.3')
+    assert set(limits._buckets) == {'10.0.0.3'}
+
+
+def test_all_buckets_dropped_when_none_can_be_pruned(clock, monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_TRACKED', 2)
+    limits = Admission(ip_rate=1, ip_burst=2)
+    admit_and_release(limits, '10.0.0.1')
+    admit_and_release(limits, '10.0.0.2')
+    admit_and_release(limits, '10.0.0.3')
+    assert set(limits._buckets) == {'10.0.0.3'}
+
+
+def test_token_bucket_pacing(clock):
+    bucket = TokenBucket(rate=100, burst=100)
+    assert bucket.take(100) == 0.0  # The burst goes through at once
+    assert bucket.take(50) == pytest.approx(0.5)  # Then the caller is ahead of the rate
+    clock[0] += 0.5
+    assert bucket.take(50) == pytest.approx(0.5)  # The debt was paid, this is new
+    clock[0] += 10
+    assert bucket.take(10) == 0.0
+    assert bucket.tokens == 90  # Refilled up to the burst only
+
+
+async def closed_by_proxy(reader, timeout=5):
+    return await asyncio.wait_for(reader.read(), timeout) == b''
+
+
+def test_socks5_handshake_deadline():
+    async def run():
+        limits = Admission(handshake_timeout=0.2)
+        proxy, port, task = await start_proxy(Socks5Proxy, limits=limits)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'\x05')  # Half a greeting
+            assert await closed_by_proxy(reader)
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+        return limits
+
+    limits = asyncio.run(run())
+    assert (limits.handshake_timeouts, limits.auth_timeouts) == (1, 0)
+
+
+def test_socks5_auth_deadline():
+    async def run():
+        limits = Admission(handshake_timeout=5, auth_timeout=0.2)
+        proxy, port, task = await start_proxy(Socks5Proxy, user='alice', password='secret', limits=limits)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'\x05\x01\x02')
+            assert await reader.readexactly(2) == b'\x05\x02'
+            assert await closed_by_proxy(reader, 2)  # Well before the handshake deadline
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+        return limits
+
+    limits = asyncio.run(run())
+    assert (limits.handshake_timeouts, limits.auth_timeouts) == (0, 1)
+
+
+def test_http_request_header_timeout_is_408():
+    async def run():
+        limits = Admission(handshake_timeout=0.2)
+        proxy, port, task = await start_proxy(limits=limits)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET http://127.0.0.1/ HTTP/1.1\r\n')  # Never finished
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+        return response, limits
+
+    response, limits = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 408 ')
+    assert limits.handshake_timeouts == 1
+
+
+@pytest.mark.parametrize('limits, status', [
+    (dict(max_connections=1), b'503'),
+    (dict(max_per_ip=1), b'503'),
+    (dict(ip_rate=0.1, ip_burst=1), b'429'),
+])
+def test_http_rejections(limits, status):
+    async def run():
+        proxy, port, task = await start_proxy(limits=Admission(**limits))
+        try:
+            first = await asyncio.open_connection('127.0.0.1', port)
+            await asyncio.sleep(0.05)  # Accepted and counted
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            first[1].close()
+        finally:
+            await stop_proxy(proxy, task)
+        return response
+
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 ' + status + b' ')
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+@pytest.mark.parametrize('engine', ['stream', 'auto'])
+def test_idle_timeout_closes_tunnels(engine):
+    async def run():
+        server = await asyncio.start_server(echo, '127.0.0.1', 0)
+        target = server.sockets[0].getsockname()[1]
+        limits = Admission(idle_timeout=0.3)
+        proxy, port, task = await start_proxy(limits=limits, relay_engine=engine)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % target)
+            await reader.readuntil(b'\r\n\r\n')
+            for _ in range(3):  # Traffic keeps it open past the idle timeout
+                writer.write(b'ping')
+                assert await reader.readexactly(4) == b'ping'
+                await asyncio.sleep(0.15)
+            assert await closed_by_proxy(reader)
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+            server.close()
+        return limits
+
+    assert asyncio.run(run()).idle_timeouts == 1
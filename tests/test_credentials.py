@@ -0,0 +1,182 @@
+import os
+import signal
+import asyncio
+
+import pytest
+
+import credentials
+import workers
+from socks5 import Socks5Proxy
+
+# Published vectors: Apache's apr1 example and {SHA} of 'password'.
+APR1_ENTRY = 'bob:$apr1$r31.....$HqJZimcKQFAMYayBlzkrA/'
+SHA_ENTRY = 'carol:{SHA}W6ph5Mm5Pz8GgiULbPgzG37mj9g='
+ROUNDS = 1000  # Keeps pbkdf2 fast in tests
+
+
+@pytest.fixture
+def htpasswd(tmp_path):
+    path = tmp_path / 'htpasswd'
+    path.write_text(f"alice:{credentials.hash_password('secret')}\n")
+    return str(path)
+
+
+@pytest.fixture
+def users_file(tmp_path):
+    path = tmp_path / 'users'
+    path.write_text(f"alice:{credentials.hash_password('secret', ROUNDS)}\n{APR1_ENTRY}\n{SHA_ENTRY}\n")
+    return path
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic() of the credentials module, advanced by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(credentials.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def hash_checks(monkeypatch):
+    """Hashes passed to check_password, in order."""
+    checks = []
+    check_password = credentials.check_password
+
+    def recording(hashed, password):
+        checks.append(hashed)
+        return check_password(hashed, password)
+
+    monkeypatch.setattr(credentials, 'check_password', recording)
+    return checks
+
+
+def verify(store, *logins):
+    async def run():
+        return [await store.verify(user, password) for user, password in logins]
+
+    return asyncio.run(run())
+
+
+def rewrite(path, text, stamp=None):
+    """Write `text` in place, `stamp` (an os.stat_result) keeps the old mtime."""
+    path.write_text(text)
+    if stamp is not None:
+        os.utime(path, ns=(stamp.st_atime_ns, stamp.st_mtime_ns))
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_verify_supported_schemes(users_file, threads):
+    store = credentials.HtpasswdFile(str(users_file), cache_ttl=0, threads=threads)
+    assert verify(store, ('alice', 'secret'), ('bob', 'myPassword'), ('carol', 'password')) == [True] * 3
+    assert verify(store, ('alice', 'Secret'), ('bob', 'mypassword'), ('carol', 'password ')) == [False] * 3
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_success_and_failure_counters(users_file, threads):
+    store = credentials.HtpasswdFile(str(users_file), threads=threads)
+    verify(store, ('alice', 'secret'), ('alice', 'secret'), ('alice', 'wrong'), ('mallory', 'x'), ('eve', 'y'))
+    assert store.successes == {'alice': 2}
+    assert store.failures == {'alice': 1, credentials.UNKNOWN_USER: 2}
+    assert store.stats()['successes'] == 2 and store.stats()['failures'] == 3
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_unknown_users_are_checked_against_the_dummy_hash(users_file, hash_checks, threads):
+    store = credentials.HtpasswdFile(str(users_file), threads=threads)
+    assert verify(store, ('mallory', 'secret')) == [False]
+    assert hash_checks == [store._dummy]
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_cache_hit_and_expiry(users_file, clock, hash_checks, threads):
+    store = credentials.HtpasswdFile(str(users_file), cache_ttl=300, threads=threads)
+    assert verify(store, ('alice', 'secret'), ('alice', 'secret')) == [True, True]
+    assert (len(hash_checks), store.cache_hits) == (1, 1)
+
+    assert verify(store, ('alice', 'wrong')) == [False]  # Never answered from the cache
+    assert (len(hash_checks), store.cache_hits) == (2, 1)
+
+    clock[0] += 301
+    assert verify(store, ('alice', 'secret')) == [True]
+    assert (len(hash_checks), store.cache_hits) == (3, 1)
+
+
+def test_cache_entry_dropped_when_the_hash_changes(users_file, clock, hash_checks):
+    store = credentials.HtpasswdFile(str(users_file), cache_ttl=300, threads=0)
+    assert verify(store, ('alice', 'secret')) == [True]
+    stamp = users_file.stat()
+    # Same password, new salt: same length, so only the mtime tells the file changed.
+    text = users_file.read_text().replace(store.users['alice'], credentials.hash_password('secret', ROUNDS))
+    rewrite(users_file, text)
+    os.utime(users_file, ns=(stamp.st_atime_ns, stamp.st_mtime_ns + 10 ** 9))
+
+    clock[0] += credentials.CHECK_INTERVAL
+    assert verify(store, ('alice', 'secret')) == [True]
+    assert store.reloads == 1
+    assert store.cache_hits == 0 and len(hash_checks) == 2
+
+
+def test_reload_when_the_inode_changes(users_file, clock):
+    store = credentials.HtpasswdFile(str(users_file), threads=0)
+    assert verify(store, ('bob', 'myPassword')) == [True]  # First check: the file is stat()ed now
+    stamp = users_file.stat()
+    # Renamed over the old file (how credentials.py writes it), same size and mtime.
+    replacement = users_file.with_name('users.tmp')
+    rewrite(replacement, users_file.read_text().replace('bob:', 'dan:'), stamp)
+    os.replace(replacement, users_file)
+    assert users_file.stat().st_ino != stamp.st_ino
+
+    assert verify(store, ('dan', 'myPassword')) == [False]  # Within CHECK_INTERVAL: not looked at yet
+    clock[0] += credentials.CHECK_INTERVAL
+    assert verify(store, ('dan', 'myPassword')) == [True]
+    assert 'bob' not in store.users and store.reloads == 1
+
+
+def test_unreadable_file_keeps_the_old_users(users_file, clock):
+    store = credentials.HtpasswdFile(str(users_file), threads=0)
+    users = dict(store.users)
+
+    users_file.unlink()
+    clock[0] += credentials.CHECK_INTERVAL
+    assert verify(store, ('bob', 'myPassword')) == [True]  # Missing: keep the last good list
+
+    users_file.mkdir()  # Back, but can not be read
+    clock[0] += credentials.CHECK_INTERVAL
+    assert verify(store, ('bob', 'myPassword')) == [True]
+    store.reload()
+    assert store.users == users and store.reloads == 0
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        credentials.CredentialStore()
+
+    class CheckOnly(credentials.CredentialStore):
+        async def check(self, user, password):
+            return False
+
+    with pytest.raises(TypeError):
+        CheckOnly()
+
+
+def test_sighup_reloads_reloadable_stores_only(htpasswd):
+    static = Socks5Proxy('127.0.0.1', 0, user='alice', password='secret')
+    assert signal.SIGHUP not in static.signal_handlers(reuse_port=False)
+
+    proxy = Socks5Proxy('127.0.0.1', 0, store=credentials.HtpasswdFile(htpasswd, threads=0))
+    assert proxy.signal_handlers(reuse_port=False)[signal.SIGHUP] == proxy.credentials.reload
+    assert signal.SIGHUP not in proxy.signal_handlers(reuse_port=True)
+
+
+def test_sighup_drains_worker_with_htpasswd(htpasswd):
+    proxy = Socks5Proxy('127.0.0.1', 0, store=credentials.HtpasswdFile(htpasswd, threads=0))
+
+    async def run():
+        worker = asyncio.create_task(workers.serve_worker(proxy, 1))
+        while proxy.server is None or not proxy.server.sockets:
+            await asyncio.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.wait_for(worker, 5)
+
+    asyncio.run(run())
+    assert not proxy.server.is_serving()
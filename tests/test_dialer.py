@@ -0,0 +1,199 @@
+import time
+import errno
+import socket
+import struct
+import asyncio
+
+import pytest
+
+import dialer
+from socks5 import Socks5Proxy
+from servers import start_proxy, stop_proxy
+
+
+async def listener():
+    server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_failure_is_remembered_per_port():
+    async def run():
+        server, port = await listener()
+        async with server:
+            upstream = dialer.Dialer()
+            # A timeout to another (firewalled) port of the same host.
+            upstream._remember('127.0.0.1', 9, dialer.REP_TTL_EXPIRED)
+            assert upstream._candidates(['127.0.0.1'], port) == ['127.0.0.1']
+            _, writer = await upstream.dial(['127.0.0.1'], port)
+            writer.close()
+
+    asyncio.run(run())
+
+
+def test_recently_failed_address_is_tried_last_not_skipped():
+    async def run():
+        server, port = await listener()
+        async with server:
+            upstream = dialer.Dialer()
+            upstream._remember('127.0.0.1', port, dialer.REP_TTL_EXPIRED)
+            assert upstream._candidates(['127.0.0.1', '::1', '127.0.0.2'], port) == ['::1', '127.0.0.2', '127.0.0.1']
+            # The only address failed recently, it is still dialed and forgiven once it connects.
+            _, writer = await upstream.dial(['127.0.0.1'], port)
+            writer.close()
+            assert ('127.0.0.1', port) not in upstream._failures
+
+    asyncio.run(run())
+
+
+def test_candidates_alternate_families():
+    upstream = dialer.Dialer()
+    addresses = ['2001:db8::1', '2001:db8::2', '192.0.2.1', '192.0.2.2']
+    assert upstream._candidates(addresses, 443) == ['2001:db8::1', '192.0.2.1', '2001:db8::2', '192.0.2.2']
+
+
+def test_refusals_are_not_remembered():
+    upstream = dialer.Dialer()
+    upstream._remember('192.0.2.1', 80, dialer.REP_CONNECTION_REFUSED)
+    assert not upstream._failures
+
+
+
+@pytest.mark.parametrize('exc, rep', [
+    (ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused'), dialer.REP_CONNECTION_REFUSED),
+    (OSError(errno.ETIMEDOUT, 'Connection timed out'), dialer.REP_TTL_EXPIRED),
+    (TimeoutError(), dialer.REP_TTL_EXPIRED),
+    (dialer.DialError(dialer.REP_TTL_EXPIRED, 'Connect timed out'), dialer.REP_TTL_EXPIRED),
+    (OSError(errno.ENETUNREACH, 'Network is unreachable'), dialer.REP_NETWORK_UNREACHABLE),
+    (OSError(errno.EHOSTUNREACH, 'No route to host'), dialer.REP_HOST_UNREACHABLE),
+    (socket.gaierror(socket.EAI_NONAME, 'Name or service not known'), dialer.REP_HOST_UNREACHABLE),
+    (OSError(errno.EPERM, 'Operation not permitted'), dialer.REP_GENERAL_FAILURE),
+    (ValueError(), dialer.REP_GENERAL_FAILURE),
+])
+def test_reply_code(exc, rep):
+    assert dialer.reply_code(exc) == rep
+
+
+@pytest.fixture
+def stub_connect(monkeypatch):
+    """
+    asyncio.open_connection for the addresses put in the returned dict: None never
+    completes, an exception is raised, a (delay, port) pair connects to that port
+    on 127.0.0.1 after `delay` seconds. Other addresses are really connected to.
+    """
+    stubs = {}
+    open_connection = asyncio.open_connection
+
+    async def stub(host, port, **kwargs):
+        if host not in stubs:
+            return await open_connection(host, port, **kwargs)
+        behaviour = stubs[host]
+        if behaviour is None:
+            await asyncio.get_running_loop().create_future()
+        if isinstance(behaviour, BaseException):
+            raise behaviour
+        delay, real_port = behaviour
+        await asyncio.sleep(delay)
+        return await open_connection('127.0.0.1', real_port, **kwargs)
+
+    monkeypatch.setattr(dialer.asyncio, 'open_connection', stub)
+    return stubs
+
+
+def test_connect_deadline(stub_connect):
+    stub_connect['192.0.2.1'] = None
+    upstream = dialer.Dialer(timeout=0.2)
+
+    async def run():
+        with pytest.raises(dialer.DialError) as info:
+            await asyncio.wait_for(upstream.dial(['192.0.2.1'], 80), 5)
+        return info.value
+
+    assert asyncio.run(run()).rep == dialer.REP_TTL_EXPIRED
+    assert ('192.0.2.1', 80) in upstream._failures
+
+
+def test_later_attempt_wins_over_a_slow_first_one(stub_connect):
+    async def run():
+        server, port = await listener()
+        async with server:
+            stub_connect['192.0.2.1'] = (2, port)  # Would connect, but far too late
+            upstream = dialer.Dialer(timeout=5, attempt_delay=0.05)
+            started = time.monotonic()
+            _, writer = await upstream.dial(['192.0.2.1', '127.0.0.1'], port)
+            elapsed = time.monotonic() - started
+            writer.close()
+        return upstream, port, elapsed
+
+    upstream, port, elapsed = asyncio.run(run())
+    assert elapsed < 1
+    # The slow first address is tried last next time.
+    assert upstream._candidates(['192.0.2.1', '127.0.0.1'], port) == ['127.0.0.1', '192.0.2.1']
+
+
+async def socks_connect(port, request):
+    """REP byte of a no-auth SOCKS5 CONNECT with `request` (ATYP, DST.ADDR, DST.PORT)."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'\x05\x01\x00')
+    assert await reader.readexactly(2) == b'\x05\x00'
+    writer.write(b'\x05\x01\x00' + request)
+    reply = await asyncio.wait_for(reader.readexactly(10), 5)
+    writer.close()
+    return reply[1]
+
+
+def ipv4_request(address, port):
+    return b'\x01' + socket.inet_aton(address) + struct.pack('!H', port)
+
+
+@pytest.mark.parametrize('behaviour, rep', [
+    (None, dialer.REP_TTL_EXPIRED),
+    (ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused'), dialer.REP_CONNECTION_REFUSED),
+    (OSError(errno.ENETUNREACH, 'Network is unreachable'), dialer.REP_NETWORK_UNREACHABLE),
+])
+def test_socks5_reply_for_connect_failures(stub_connect, behaviour, rep):
+    stub_connect['192.0.2.1'] = behaviour
+
+    async def run():
+        proxy, port, task = await start_proxy(Socks5Proxy, upstream=dialer.Dialer(timeout=0.2))
+        try:
+            return await socks_connect(port, ipv4_request('192.0.2.1', 80))
+        finally:
+            await stop_proxy(proxy, task)
+
+    assert asyncio.run(run()) == rep
+
+
+def test_socks5_reply_for_unresolvable_names():
+    async def run():
+        proxy, port, task = await start_proxy(Socks5Proxy)
+
+        async def resolve(host):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+        proxy.dns.resolve = resolve
+        try:
+            return await socks_connect(port, b'\x03\x0bexample.com\x00\x50')
+        finally:
+            await stop_proxy(proxy, task)
+
+    assert asyncio.run(run()) == dialer.REP_HOST_UNREACHABLE
+
+
+def test_socks5_connects_through_the_race(stub_connect):
+    stub_connect['192.0.2.1'] = None
+
+    async def run():
+        server, target = await listener()
+        async with server:
+            proxy, port, task = await start_proxy(Socks5Proxy, upstream=dialer.Dialer(timeout=5, attempt_delay=0.05))
+
+            async def resolve(host):
+                return ['192.0.2.1', '127.0.0.1']
+
+            proxy.dns.resolve = resolve
+            try:
+                return await socks_connect(port, b'\x03\x0bexample.com' + struct.pack('!H', target))
+            finally:
+                await stop_proxy(proxy, task)
+
+    assert asyncio.run(run()) == dialer.REP_SUCCEEDED
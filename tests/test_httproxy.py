@@ -0,0 +1,347 @@
+import asyncio
+
+import pytest
+
+import httproxy
+from servers import Origin, ok, request, start_proxy, stop_proxy
+
+
+@pytest.mark.parametrize('headers, framing', [
+    ([], None),
+    ([('Content-Length', '0')], None),
+    ([('Content-Length', '12')], 12),
+    ([('Content-Length', '12'), ('content-length', '12')], 12),
+    ([('Content-Length', '12, 12')], 12),
+    ([('Transfer-Encoding', 'chunked')], 'chunked'),
+    ([('Transfer-Encoding', 'gzip, chunked')], 'chunked'),
+    ([('Transfer-Encoding', 'gzip'), ('Transfer-Encoding', 'chunked')], 'chunked'),
+    ([('Content-Length', '4'), ('Transfer-Encoding', 'chunked')], 'chunked'),
+])
+def test_request_framing(headers, framing):
+    assert httproxy.body_framing(headers) == framing
+
+
+@pytest.mark.parametrize('headers', [
+    [('Transfer-Encoding', 'gzip')],
+    [('Transfer-Encoding', 'chunked, gzip')],
+    [('Transfer-Encoding', 'chunked, chunked')],
+    [('Transfer-Encoding', 'identity')],
+    [('Content-Length', '4'), ('Content-Length', '5')],
+    [('Content-Length', '4, 5')],
+    [('Content-Length', '-1')],
+    [('Content-Length', '+4')],
+    [('Content-Length', '0x4')],
+    [('Content-Length', '²')],
+])
+def test_ambiguous_request_framing_is_rejected(headers):
+    with pytest.raises(httproxy.HttpError) as e:
+        httproxy.body_framing(headers)
+    assert e.value.status == 400
+
+
+@pytest.mark.parametrize('headers, framing', [
+    ([], 'eof'),
+    ([('Content-Length', '0')], None),
+    ([('Transfer-Encoding', 'gzip')], 'eof'),
+    ([('Transfer-Encoding', 'gzip, chunked'), ('Content-Length', '9')], 'chunked'),
+])
+def test_response_framing(headers, framing):
+    assert httproxy.body_framing(headers, response=True) == framing
+
+
+def test_filter_headers_normalizes_content_length():
+    headers = [('Host', 'example.com'), ('Accept', '*/*'), ('Content-Length', '4'), ('content-length', '4'),
+               ('Connection', 'x-foo'), ('X-Foo', '1'), ('Keep-Alive', 'timeout=5')]
+    assert httproxy.filter_headers(headers) == [('Accept', '*/*'), ('Content-Length', '4')]
+
+
+def test_filter_headers_drops_content_length_next_to_transfer_encoding():
+    headers = [('Content-Length', '4'), ('Transfer-Encoding', 'chunked')]
+    assert httproxy.filter_headers(headers) == [('Transfer-Encoding', 'chunked')]
+
+
+class Sink:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def copy_chunked(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        sink = Sink()
+        await httproxy.copy_chunked(reader, sink)
+        return bytes(sink.data)
+
+    return asyncio.run(run())
+
+
+def test_copy_chunked_relays_verbatim():
+    body = b'4;ext=1\r\nWiki\r\n5 ; x\r\npedia\r\n0\r\nTrailer: 1\r\n\r\n'
+    assert copy_chunked(body + b'GET / HTTP/1.1\r\n') == body
+
+
+@pytest.mark.parametrize('size', [b'0x4', b'+4', b'-4', b'4_0', b' 4', b'4 ', b'', b'g', b'1' * 17])
+def test_copy_chunked_rejects_malformed_sizes(size):
+    with pytest.raises(ValueError):
+        copy_chunked(size + b'\r\nWiki\r\n0\r\n\r\n')
+
+
+def test_smuggled_content_length_is_not_forwarded():
+    # CL.TE: framed as chunked by the proxy, a Content-Length-first origin must never see the 4.
+    async def run():
+        origin = await Origin().start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, (
+                b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nContent-Length: 4\r\nTransfer-Encoding: chunked\r\n'
+                b'Connection: close\r\n\r\n0\r\n\r\n' % origin.port))
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response, origin.requests
+
+    response, requests = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 200 ')
+    head = requests[0][0].lower()
+    assert b'transfer-encoding: chunked' in head
+    assert b'content-length' not in head
+
+
+@pytest.mark.parametrize('framing', [
+    b'Transfer-Encoding: gzip\r\n',
+    b'Content-Length: 4\r\nContent-Length: 5\r\n',
+])
+def test_ambiguous_request_gets_400(framing):
+    async def run():
+        origin = await Origin().start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'POST http://127.0.0.1:%d/ HTTP/1.1\r\n%s\r\nbody' % (origin.port, framing))
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response, origin.requests
+
+    response, requests = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 400 ')
+    assert requests == []
+
+
+def test_response_with_zero_content_length_is_not_read_until_close():
+    async def run():
+        origin = await Origin(respond=lambda head, body: ok(b'')).start()
+        proxy, port, task = await start_proxy()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            heads = []
+            for _ in range(2):
+                writer.write(b'GET http://127.0.0.1:%d/ HTTP/1.1\r\n\r\n' % origin.port)
+                heads.append(await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5))
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return heads
+
+    for head in asyncio.run(run()):
+        assert b'Content-Length: 0' in head and b'Connection: keep-alive' in head
+
+
+def chunked_response(head, body):
+    return (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'4\r\nWiki\r\n5;ext\r\npedia\r\n0\r\nX-Trailer: 1\r\n\r\n')
+
+
+@pytest.mark.parametrize('version', [b'HTTP/1.0', b'HTTP/1.1'])
+def test_chunked_response_framing_per_client_version(version):
+    async def run():
+        origin = await Origin(respond=chunked_response).start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://127.0.0.1:%d/ %s\r\nConnection: close\r\n\r\n'
+                                     % (origin.port, version))
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response
+
+    head, _, body = asyncio.run(run()).partition(b'\r\n\r\n')
+    if version == b'HTTP/1.0':
+        # Close-delimited, RFC 7230 3.3.1 forbids chunked towards HTTP/1.0.
+        assert b'transfer-encoding' not in head.lower()
+        assert b'Connection: close' in head
+        assert body == b'Wikipedia'
+    else:
+        assert b'Transfer-Encoding: chunked' in head
+        assert body == b'4\r\nWiki\r\n5;ext\r\npedia\r\n0\r\nX-Trailer: 1\r\n\r\n'
+
+
+def test_dechunked_origin_connection_is_reused():
+    async def run():
+        origin = await Origin(respond=chunked_response).start()
+        proxy, port, task = await start_proxy()
+        try:
+            for _ in range(2):
+                await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.0\r\n\r\n' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return origin.connections, proxy.pool.hits
+
+    assert asyncio.run(run()) == (1, 1)
+
+
+def test_no_interim_responses_for_http10_clients():
+    async def run():
+        origin = await Origin(respond=lambda head, body: b'HTTP/1.1 100 Continue\r\n\r\n' + ok(b'done')).start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.0\r\n\r\n' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\ndone')
+
+
+def test_dechunked_headers():
+    headers = [('Transfer-Encoding', 'gzip, chunked'), ('X-A', '1')]
+    assert httproxy.dechunked_headers(headers) == [('Transfer-Encoding', 'gzip'), ('X-A', '1')]
+    assert httproxy.dechunked_headers([('Transfer-Encoding', 'chunked')]) == []
+
+
+async def upgrade_origin(reader, writer):
+    # Switches to an echo protocol when asked to, like a WebSocket server after its handshake.
+    head = await reader.readuntil(b'\r\n\r\n')
+    if b'\r\nUpgrade: echo\r\n' in head and b'\r\nConnection: Upgrade\r\n' in head:
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: echo\r\nConnection: Upgrade\r\n\r\n')
+        while data := await reader.read(4096):
+            writer.write(data)
+            await writer.drain()
+    else:
+        writer.write(ok(b'no upgrade'))
+    writer.close()
+
+
+@pytest.mark.parametrize('engine', ['stream', 'auto'])
+def test_protocol_upgrade_is_passed_through(engine):
+    async def run():
+        origin = await asyncio.start_server(upgrade_origin, '127.0.0.1', 0)
+        origin_port = origin.sockets[0].getsockname()[1]
+        proxy, port, task = await start_proxy(relay_engine=engine)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET http://127.0.0.1:%d/chat HTTP/1.1\r\nConnection: keep-alive, Upgrade\r\n'
+                         b'Upgrade: echo\r\n\r\nearly' % origin_port)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            writer.write(b' bird')
+            echoed = await asyncio.wait_for(reader.readexactly(10), 5)
+            writer.close()
+        finally:
+            await stop_proxy(proxy, task)
+            origin.close()
+        return head, echoed
+
+    head, echoed = asyncio.run(run())
+    assert head.startswith(b'HTTP/1.1 101 ')
+    assert b'Upgrade: echo' in head and b'Connection: Upgrade' in head
+    assert echoed == b'early bird'
+
+
+def test_upgrade_is_not_requested_without_connection_upgrade():
+    async def run():
+        origin = await asyncio.start_server(upgrade_origin, '127.0.0.1', 0)
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.1\r\nUpgrade: echo\r\n'
+                                     b'Connection: close\r\n\r\n' % origin.sockets[0].getsockname()[1])
+        finally:
+            await stop_proxy(proxy, task)
+            origin.close()
+        return response
+
+    assert asyncio.run(run()).endswith(b'no upgrade')
+
+
+def test_unsolicited_101_is_a_bad_gateway():
+    async def run():
+        origin = await Origin(respond=lambda head, body: b'HTTP/1.1 101 Switching Protocols\r\n'
+                              b'Upgrade: echo\r\nConnection: Upgrade\r\n\r\n').start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.1\r\n\r\n' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response
+
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 502 ')
+
+
+@pytest.mark.parametrize('head', [
+    # TE.CL: an origin accepting bare LF would frame the body as chunked.
+    b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nX-A: a\nTransfer-Encoding: chunked\r\nContent-Length: 5\r\n\r\n',
+    b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nX-A: a\rTransfer-Encoding: chunked\r\nContent-Length: 5\r\n\r\n',
+    b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nX-A: a\0\r\nContent-Length: 5\r\n\r\n',
+    b'POST\nX-A: a http://127.0.0.1:%d/ HTTP/1.1\r\nContent-Length: 5\r\n\r\n',
+])
+def test_bare_cr_lf_nul_in_request_head_gets_400(head):
+    async def run():
+        origin = await Origin().start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, head % origin.port + b'0\r\n\r\n')
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response, origin.requests
+
+    response, requests = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 400 ')
+    assert requests == []
+
+
+def test_bare_lf_in_response_head_is_a_bad_gateway():
+    async def run():
+        origin = await Origin(respond=lambda head, body: b'HTTP/1.1 200 OK\r\nX-A: a\nContent-Length: 2\r\n'
+                              b'Content-Length: 2\r\n\r\nok').start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.1\r\n\r\n' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response
+
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 502 ')
+
+
+@pytest.mark.parametrize('authority', [b'127.0.0.1:%d', b'user:secret@127.0.0.1:%d'])
+def test_host_comes_from_the_request_target(authority):
+    async def run():
+        origin = await Origin().start()
+        proxy, port, task = await start_proxy()
+        try:
+            response = await request(port, b'GET http://%s/x HTTP/1.1\r\nHost: evil.example\r\n'
+                                           b'Connection: close\r\n\r\n' % (authority % origin.port))
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response, origin.requests, origin.port
+
+    response, requests, origin_port = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 200 ')
+    head = requests[0][0]
+    assert b'\r\nHost: 127.0.0.1:%d\r\n' % origin_port in head
+    assert b'evil.example' not in head and b'secret' not in head
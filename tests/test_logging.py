@@ -0,0 +1,81 @@
+import re
+import asyncio
+import logging
+import threading
+
+import pytest
+
+import util
+
+
+def test_task_names_in_log(tmp_path):
+    path = tmp_path / 'zzapp.log'
+    logger = util.setup_logging(str(path), 1, False)
+    try:
+        async def work(n):
+            logger.info("first %s", n)
+            await asyncio.sleep(0)
+            logger.info("second %s", n)
+
+        async def main():
+            logger.info("main")
+            await asyncio.gather(asyncio.create_task(work(1), name='one'), asyncio.create_task(work(2)))
+
+        logger.info("outside")
+        asyncio.run(main())
+    finally:
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+
+    lines = path.read_text().splitlines()
+    tasks = [re.search(r'\]\[\d+\]\[([^]]*)\] ', line).group(1) for line in lines]
+    assert tasks[0] == 'Main'
+    assert tasks[1].startswith('Task-')  # asyncio.run()'s main task
+    assert tasks[2:] == ['one', tasks[3], 'one', tasks[3]] and tasks[3].startswith('Task-')
+    assert tasks[3] != tasks[1]
+
+
+
+class StuckHandler(logging.Handler):
+    """Blocks in emit() until `unblock` is set, like a stalled disk."""
+
+    def __init__(self):
+        super().__init__()
+        self.unblock = threading.Event()
+        self.entered = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.entered.set()
+        self.unblock.wait()
+        self.records.append(record.getMessage())
+
+
+def fill(handler, target):
+    """One record stuck in the writer, then a full queue. Returns the records accepted."""
+    n = 0
+    while not handler.dropped:
+        if n == 1:
+            assert target.entered.wait(5)
+        handler.handle(logging.makeLogRecord({'msg': "record %s", 'args': (n,), 'levelno': logging.INFO}))
+        n += 1
+    assert handler.queue.full()
+    return n - handler.dropped
+
+
+@pytest.mark.parametrize('stall', [0.1, 1.0])
+def test_close_with_full_queue(monkeypatch, stall):
+    # 0.1: the writer catches up and every queued record is written; 1.0: longer than
+    # STOP_TIMEOUT, the rest of the queue is discarded so close() still returns.
+    monkeypatch.setattr(util, 'STOP_TIMEOUT', 0.5)
+    target = StuckHandler()
+    handler = util.QueueLogHandler(target, 4)
+    accepted = fill(handler, target)
+    threading.Timer(stall, target.unblock.set).start()
+    handler.close()
+    assert handler.listener is None
+    if stall < util.STOP_TIMEOUT:
+        assert len(target.records) == accepted
+    else:
+        assert len(target.records) < accepted
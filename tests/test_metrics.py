@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import metrics
+from servers import Origin, ok, request, start_proxy, stop_proxy
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+@pytest.mark.parametrize('engine', ['stream', 'auto'])
+def test_tunnel_bytes_counted_while_open(engine):
+    async def run():
+        server = await asyncio.start_server(echo, '127.0.0.1', 0)
+        target = server.sockets[0].getsockname()[1]
+        m = metrics.ProxyMetrics(port=0)
+        proxy, port, task = await start_proxy(metrics=m, relay_engine=engine)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % target)
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'x' * 1000)
+            await reader.readexactly(1000)
+            await wait_for(lambda: m.relayed() == {'upstream': 1000, 'downstream': 1000})
+            assert len(m.tunnels) == 1
+
+            writer.close()
+            await wait_for(lambda: not m.tunnels)
+            assert m.relayed() == {'upstream': 1000, 'downstream': 1000}
+        finally:
+            await stop_proxy(proxy, task)
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_plain_requests_counted():
+    async def run():
+        origin = await Origin(respond=lambda head, body: ok(b'hello')).start()
+        m = metrics.ProxyMetrics(port=0)
+        proxy, port, task = await start_proxy(metrics=m)
+        try:
+            response = await request(port, b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nContent-Length: 4\r\n'
+                                           b'Connection: close\r\n\r\nbody' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        (head, body), = origin.requests
+        return m, response, len(head) + len(body)
+
+    m, response, sent = asyncio.run(run())
+    assert m.relayed() == {'upstream': sent, 'downstream': len(response)}
+    assert not m.tunnels
+
+
+def test_stats_exported_as_counters_and_gauges():
+    async def run():
+        m = metrics.ProxyMetrics(port=0)
+        proxy, port, task = await start_proxy(metrics=m)
+        await stop_proxy(proxy, task)
+        return m.render()
+
+    text = asyncio.run(run())
+    assert '# TYPE zzproxy_relayed_bytes_total counter' in text
+    assert '# TYPE zzproxy_dns_cache gauge' in text
+    assert 'zzproxy_dns_cache{stat="size"} 0' in text
+    assert '# TYPE zzproxy_dns_cache_total counter' in text
+    assert 'zzproxy_dns_cache_total{stat="hits"} 0' in text
+    assert 'zzproxy_admission_total{stat="admitted"} 0' in text
+    assert 'zzproxy_log_total{stat="dropped"} 0' in text
+    assert 'zzproxy_udp_dropped_total 0' in text
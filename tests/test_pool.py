@@ -0,0 +1,223 @@
+import asyncio
+
+import pytest
+
+from pool import ConnectionPool
+from servers import Origin, ok, request, start_proxy, stop_proxy
+
+KEY = ('127.0.0.1', 80)
+
+
+async def connect(origin, n=1):
+    return [await asyncio.open_connection('127.0.0.1', origin.port) for _ in range(n)]
+
+
+def run_with_origin(test, **kwargs):
+    async def run():
+        origin = await Origin(**kwargs).start()
+        try:
+            return await test(origin)
+        finally:
+            await origin.close()
+
+    return asyncio.run(run())
+
+
+def test_release_then_acquire_is_a_hit():
+    async def test(origin):
+        pool = ConnectionPool()
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        assert pool.acquire(KEY) == (reader, writer)
+        assert pool.acquire(KEY) is None
+        assert pool.acquire(('127.0.0.1', 81)) is None
+        pool.close()
+        writer.close()
+        return pool.stats()
+
+    stats = run_with_origin(test)
+    assert (stats['hits'], stats['misses'], stats['released'], stats['idle']) == (1, 2, 1, 0)
+
+
+def test_most_recently_used_connection_first():
+    async def test(origin):
+        pool = ConnectionPool()
+        conns = await connect(origin, 2)
+        for reader, writer in conns:
+            pool.release(KEY, reader, writer)
+        assert pool.acquire(KEY) == conns[1]
+        assert pool.acquire(KEY) == conns[0]
+        pool.close()
+
+    run_with_origin(test)
+
+
+def test_per_host_limit():
+    async def test(origin):
+        pool = ConnectionPool(max_idle=10, max_per_host=2)
+        conns = await connect(origin, 3)
+        for reader, writer in conns:
+            pool.release(KEY, reader, writer)
+        # The oldest idle connection made room and was closed.
+        assert conns[0][1].is_closing()
+        assert pool.stats()['idle'] == 2
+        assert pool.stats()['discarded'] == 1
+        pool.close()
+
+    run_with_origin(test)
+
+
+def test_total_limit_evicts_least_recently_used_host():
+    async def test(origin):
+        pool = ConnectionPool(max_idle=2, max_per_host=2)
+        conns = await connect(origin, 3)
+        pool.release(('a', 80), *conns[0])
+        pool.release(('b', 80), *conns[1])
+        pool.release(('c', 80), *conns[2])
+        assert conns[0][1].is_closing()
+        assert pool.acquire(('a', 80)) is None
+        assert pool.acquire(('b', 80)) == conns[1]
+        assert pool.acquire(('c', 80)) == conns[2]
+        pool.close()
+
+    run_with_origin(test)
+
+
+def test_disabled_pool_closes_released_connections():
+    async def test(origin):
+        pool = ConnectionPool(max_idle=0)
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        assert writer.is_closing()
+        assert pool.acquire(KEY) is None
+
+    run_with_origin(test)
+
+
+def test_idle_expiry_on_acquire(monkeypatch):
+    async def test(origin):
+        import pool as pool_module
+        now = [1000.0]
+        monkeypatch.setattr(pool_module.time, 'monotonic', lambda: now[0])
+        pool = ConnectionPool(idle_timeout=30)
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        now[0] += 31
+        assert pool.acquire(KEY) is None
+        assert writer.is_closing()
+        pool.close()
+        return pool.stats()
+
+    assert run_with_origin(test)['expired'] == 1
+
+
+def test_idle_connections_are_swept():
+    async def test(origin):
+        pool = ConnectionPool(idle_timeout=0.05)
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        await asyncio.sleep(0.2)
+        assert writer.is_closing()
+        assert pool.stats()['idle'] == 0
+        return pool.stats()
+
+    assert run_with_origin(test)['expired'] == 1
+
+
+def test_connection_closed_by_origin_is_not_reused():
+    async def test(origin):
+        pool = ConnectionPool()
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        origin.drop_idle()
+        await asyncio.sleep(0.05)  # Let the FIN arrive
+        assert pool.acquire(KEY) is None
+        assert writer.is_closing()
+        return pool.stats()
+
+    stats = run_with_origin(test)
+    assert (stats['unhealthy'], stats['hits']) == (1, 0)
+
+
+def test_connection_with_unread_data_is_not_reused():
+    async def test(origin):
+        pool = ConnectionPool()
+        (reader, writer), = await connect(origin)
+        pool.release(KEY, reader, writer)
+        writer.write(b'GET / HTTP/1.1\r\n\r\n')  # The answer arrives while the connection is idle
+        await asyncio.sleep(0.05)
+        assert pool.acquire(KEY) is None
+        return pool.stats()
+
+    assert run_with_origin(test)['unhealthy'] == 1
+
+
+def test_proxy_reuses_origin_connections():
+    async def test(origin):
+        proxy, port, task = await start_proxy()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for _ in range(3):
+                writer.write(b'GET http://127.0.0.1:%d/ HTTP/1.1\r\n\r\n' % origin.port)
+                await asyncio.wait_for(reader.readuntil(b'hello'), 5)
+            writer.close()
+            # A new client connection picks up the same origin connection.
+            await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.1\r\nConnection: close\r\n\r\n' % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+        return origin.connections, len(origin.requests), proxy.pool.stats()
+
+    connections, requests, stats = run_with_origin(test)
+    assert (connections, requests) == (1, 4)
+    assert (stats['hits'], stats['misses']) == (3, 1)
+
+
+class FlakyOrigin(Origin):
+    """Answers the first request on each connection, then hangs up on the next one without a response."""
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            for served in range(2):
+                head = await reader.readuntil(b'\r\n\r\n')
+                self.requests.append((head, b''))
+                if served:
+                    break
+                writer.write(ok(b'hello'))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+def flaky_origin_exchange(second_request):
+    async def run():
+        origin = await FlakyOrigin().start()
+        proxy, port, task = await start_proxy()
+        try:
+            await request(port, b'GET http://127.0.0.1:%d/ HTTP/1.1\r\nConnection: close\r\n\r\n' % origin.port)
+            response = await request(port, second_request % origin.port)
+        finally:
+            await stop_proxy(proxy, task)
+            await origin.close()
+        return response, origin.connections
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('method', [b'GET', b'HEAD', b'DELETE'])
+def test_idempotent_request_is_retried_on_stale_connection(method):
+    response, connections = flaky_origin_exchange(method + b' http://127.0.0.1:%d/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+    assert response.startswith(b'HTTP/1.1 200 ')
+    assert connections == 2
+
+
+@pytest.mark.parametrize('method', [b'POST', b'PATCH'])
+def test_non_idempotent_request_is_not_retried(method):
+    response, connections = flaky_origin_exchange(
+        method + b' http://127.0.0.1:%d/ HTTP/1.1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+    assert response.startswith(b'HTTP/1.1 502 ')
+    assert connections == 1
@@ -0,0 +1,167 @@
+import socket
+import asyncio
+
+import pytest
+
+import resolver
+
+
+class StubResolver:
+    """Stands in for loop.getaddrinfo: answers from `records`, counts and optionally delays lookups."""
+
+    def __init__(self, records, delay=0.0):
+        self.records = records  # host -> [(family, address)], missing hosts do not resolve
+        self.delay = delay
+        self.calls = []
+
+    async def __call__(self, host, port, type=0):
+        self.calls.append(host)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if host not in self.records:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(family, type, 6, '', (address, 0) if family == socket.AF_INET else (address, 0, 0, 0))
+                for family, address in self.records[host]]
+
+
+DUAL_STACK = [(socket.AF_INET6, '2001:db8::1'), (socket.AF_INET, '192.0.2.1'), (socket.AF_INET, '192.0.2.2')]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic() of the resolver module, advanced by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(resolver.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_ip_literals_skip_the_cache():
+    stub = StubResolver({})
+    dns = resolver.Resolver(getaddrinfo=stub)
+    assert asyncio.run(dns.resolve('192.0.2.7')) == ['192.0.2.7']
+    assert asyncio.run(dns.resolve('2001:db8::7')) == ['2001:db8::7']
+    assert stub.calls == []
+
+
+def test_positive_ttl(clock):
+    stub = StubResolver({'example.com': DUAL_STACK})
+    dns = resolver.Resolver(ttl=60, getaddrinfo=stub)
+
+    async def run():
+        first = await dns.resolve('example.com')
+        clock[0] += 59
+        assert await dns.resolve('Example.COM') == first
+        assert stub.calls == ['example.com']
+        clock[0] += 2
+        assert await dns.resolve('example.com') == first
+        assert stub.calls == ['example.com', 'example.com']
+
+    asyncio.run(run())
+    assert dns.stats()['hits'] == 1
+    assert dns.stats()['misses'] == 2
+
+
+def test_negative_ttl(clock):
+    stub = StubResolver({})
+    dns = resolver.Resolver(negative_ttl=10, getaddrinfo=stub)
+
+    async def run():
+        with pytest.raises(socket.gaierror):
+            await dns.resolve('missing.example')
+        clock[0] += 9
+        with pytest.raises(socket.gaierror) as e:
+            await dns.resolve('missing.example')
+        assert e.value.errno == socket.EAI_NONAME
+        assert len(stub.calls) == 1
+        clock[0] += 2
+        stub.records['missing.example'] = [(socket.AF_INET, '192.0.2.9')]
+        assert await dns.resolve('missing.example') == ['192.0.2.9']
+        assert len(stub.calls) == 2
+
+    asyncio.run(run())
+    stats = dns.stats()
+    assert (stats['negative_hits'], stats['errors'], stats['misses']) == (1, 1, 2)
+
+
+def test_zero_ttl_disables_caching():
+    stub = StubResolver({'example.com': DUAL_STACK})
+    dns = resolver.Resolver(ttl=0, getaddrinfo=stub)
+
+    async def run():
+        await dns.resolve('example.com')
+        await dns.resolve('example.com')
+
+    asyncio.run(run())
+    assert len(stub.calls) == 2
+    assert dns.stats()['size'] == 0
+
+
+def test_lru_bound():
+    stub = StubResolver({f'host{n}.example': [(socket.AF_INET, f'192.0.2.{n}')] for n in range(4)})
+    dns = resolver.Resolver(max_size=2, getaddrinfo=stub)
+
+    async def run():
+        await dns.resolve('host0.example')
+        await dns.resolve('host1.example')
+        await dns.resolve('host0.example')  # host0 is now the most recently used
+        await dns.resolve('host2.example')  # evicts host1
+        assert dns.stats()['size'] == 2
+        stub.calls.clear()
+        await dns.resolve('host0.example')
+        await dns.resolve('host2.example')
+        assert stub.calls == []
+        await dns.resolve('host1.example')
+        assert stub.calls == ['host1.example']
+
+    asyncio.run(run())
+
+
+def test_concurrent_lookups_are_coalesced():
+    stub = StubResolver({'example.com': DUAL_STACK}, delay=0.05)
+    dns = resolver.Resolver(getaddrinfo=stub)
+
+    async def run():
+        return await asyncio.gather(*(dns.resolve('example.com') for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert stub.calls == ['example.com']
+    assert all(result == results[0] for result in results)
+    stats = dns.stats()
+    assert (stats['misses'], stats['coalesced'], stats['hits']) == (1, 9, 0)
+
+
+def test_cancelled_waiter_does_not_cancel_a_shared_lookup():
+    stub = StubResolver({'example.com': DUAL_STACK}, delay=0.05)
+    dns = resolver.Resolver(getaddrinfo=stub)
+
+    async def run():
+        impatient = asyncio.create_task(dns.resolve('example.com'))
+        patient = asyncio.create_task(dns.resolve('example.com'))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        return await patient
+
+    assert asyncio.run(run()) == ['2001:db8::1', '192.0.2.1', '192.0.2.2']
+    assert len(stub.calls) == 1
+
+
+@pytest.mark.parametrize('prefer, expected', [
+    ('any', ['2001:db8::1', '192.0.2.1', '192.0.2.2']),
+    ('ipv4', ['192.0.2.1', '192.0.2.2', '2001:db8::1']),
+    ('ipv6', ['2001:db8::1', '192.0.2.1', '192.0.2.2']),
+])
+def test_family_preference(prefer, expected):
+    dns = resolver.Resolver(prefer=prefer, getaddrinfo=StubResolver({'example.com': DUAL_STACK}))
+    assert asyncio.run(dns.resolve('example.com')) == expected
+
+
+def test_ipv6_preference_moves_ipv6_first():
+    records = [(socket.AF_INET, '192.0.2.1'), (socket.AF_INET6, '2001:db8::1'), (socket.AF_INET, '192.0.2.1')]
+    dns = resolver.Resolver(prefer='ipv6', getaddrinfo=StubResolver({'example.com': records}))
+    # Duplicate answers (one per socket type or protocol) are folded.
+    assert asyncio.run(dns.resolve('example.com')) == ['2001:db8::1', '192.0.2.1']
+
+
+def test_invalid_preference():
+    with pytest.raises(ValueError):
+        resolver.Resolver(prefer='ipv5')
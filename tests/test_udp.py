@@ -0,0 +1,69 @@
+import socket
+import struct
+import asyncio
+
+import udp
+
+
+class Echo(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+def domain_header(host, port):
+    return b'\x00\x00\x00\x03' + bytes([len(host)]) + host + struct.pack('!H', port)
+
+
+def exchange(payloads, dns_ttl, expire=False):
+    """Send `payloads` to 'echo.test' through an Association, returns (replies, resolve calls)."""
+    lookups = []
+
+    async def resolve(host):
+        lookups.append(host)
+        return ['127.0.0.1']
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        echo, _ = await loop.create_datagram_endpoint(Echo, local_addr=('127.0.0.1', 0))
+        port = echo.get_extra_info('sockname')[1]
+        association = udp.Association('127.0.0.1', 0, resolve, dns_ttl=dns_ttl)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setblocking(False)
+        try:
+            relay_addr = await association.open('127.0.0.1')
+            header = domain_header(b'echo.test', port)
+            replies = []
+            for payload in payloads:
+                if expire:
+                    association._domains = {k: (v[0], 0.0) for k, v in association._domains.items()}
+                await loop.sock_sendto(client, header + payload, relay_addr)
+                reply = await asyncio.wait_for(loop.sock_recv(client, 65535), 5)
+                replies.append(reply[10:])  # After the IPv4 reply header
+            return replies
+        finally:
+            client.close()
+            association.close()
+            echo.close()
+
+    return asyncio.run(run()), lookups
+
+
+def test_domain_resolved_once_within_ttl():
+    replies, lookups = exchange([b'one', b'two', b'three'], dns_ttl=60)
+    assert replies == [b'one', b'two', b'three']
+    assert lookups == ['echo.test']
+
+
+def test_domain_resolved_again_after_ttl():
+    replies, lookups = exchange([b'one', b'two'], dns_ttl=60, expire=True)
+    assert replies == [b'one', b'two']
+    assert lookups == ['echo.test', 'echo.test']
+
+
+def test_no_domain_cache_with_zero_ttl():
+    replies, lookups = exchange([b'one', b'two'], dns_ttl=0)
+    assert replies == [b'one', b'two']
+    assert len(lookups) == 2
@@ -0,0 +1,18 @@
+import os
+import queue
+import logging
+
+import workers
+
+
+def test_worker_exits_when_log_shutdown_fails(monkeypatch):
+    def shutdown():
+        raise queue.Full
+
+    monkeypatch.setattr(logging, 'shutdown', shutdown)
+    supervisor = workers.Supervisor(1, lambda slot: None)
+    pid = supervisor.spawn(0)
+    if pid == 0:
+        os._exit(99)  # The child came back into supervisor code
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,257 @@
+import socket
+import struct
+import asyncio
+import logging
+
+logger = logging.getLogger('zzapp')
+
+# Largest UDP payload, every receive buffer is this big.
+BUFFER_SIZE = 65535
+# Datagrams read per readiness event: the first one comes through the DatagramProtocol,
+# up to UDP_BATCH - 1 more are drained straight from the socket into a reused buffer.
+UDP_BATCH = 32
+# Remote peers a single association may talk to.
+MAX_PEERS = 4096
+
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+
+
+def parse_header(data):
+    """
+    Parse the SOCKS5 UDP request header (RFC 1928 section 7).
+    Returns (atyp, host, port, payload offset), raises ValueError for malformed or fragmented datagrams.
+    """
+    if len(data) < 4 or data[0] or data[1]:
+        raise ValueError("bad header")
+    if data[2]:
+        raise ValueError("fragmented datagram")  # FRAG is optional and not supported
+    atyp = data[3]
+    if atyp == ATYP_IPV4:
+        end = 8
+        host = socket.inet_ntop(socket.AF_INET, data[4:end])
+    elif atyp == ATYP_IPV6:
+        end = 20
+        host = socket.inet_ntop(socket.AF_INET6, data[4:end])
+    elif atyp == ATYP_DOMAIN and len(data) > 4:
+        end = 5 + data[4]
+        host = bytes(data[5:end]).decode('utf-8')
+    else:
+        raise ValueError(f"bad address type {atyp}")
+    if len(data) < end + 2:
+        raise ValueError("truncated header")
+    return atyp, host, data[end] << 8 | data[end + 1], end + 2
+
+
+def encode_header(host, port):
+    """SOCKS5 UDP header carrying the address a reply came from."""
+    if ':' in host:
+        return b'\x00\x00\x00\x04' + socket.inet_pton(socket.AF_INET6, host) + struct.pack('!H', port)
+    return b'\x00\x00\x00\x01' + socket.inet_aton(host) + struct.pack('!H', port)
+
+
+class _Endpoint(asyncio.DatagramProtocol):
+    """One of the association's sockets, hands every datagram to `handler(data, addr)`."""
+
+    def __init__(self, sock, handler):
+        self.sock = sock
+        self.handler = handler
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        handler = self.handler
+        handler(data, addr)
+        # Drain what else is queued now instead of one datagram per loop iteration. The handler
+        # is done with the buffer when it returns: sends either complete or copy.
+        sock = self.sock
+        for _ in range(UDP_BATCH - 1):
+            try:
+                n, addr = sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # Errors (e.g. ICMP unreachable) surface again through the transport
+            handler(self.view[:n], addr)
+
+    def error_received(self, exc):
+        logger.debug("UDP error: %s", exc)
+
+
+class Association:
+    """
+    One UDP ASSOCIATE: a socket facing the client and one per address family facing remote peers.
+    Only datagrams from the client's IP (and port, once the first datagram fixed it) are relayed,
+    and only replies from peers the client sent to: the NAT table maps each peer to the SOCKS5
+    header of its replies and forgets it after `nat_timeout` idle seconds.
+
+    :param resolve: coroutine function returning a list of addresses for a domain name
+    :param dns_ttl: seconds a resolved domain destination is reused without calling `resolve`,
+        the resolver's own cache TTL so both expire together (0: resolve every datagram)
+    """
+
+    def __init__(self, client_ip, client_port, resolve, nat_timeout=60.0, dns_ttl=60.0):
+        self.client_ip = client_ip
+        # The port from the request, 0 when the client did not know it yet.
+        self.client_port = client_port
+        self.client_addr = None
+        self.resolve = resolve
+        self.nat_timeout = nat_timeout
+        self.dns_ttl = dns_ttl
+        self.client = None
+        self.remotes = {}  # family -> _Endpoint
+        self.nat = {}  # remote sockaddr -> [last used, reply header]
+        self._targets = {}  # raw request header -> remote sockaddr, for IP literal destinations
+        self._domains = {}  # raw request header -> (remote sockaddr, expires), for domain destinations
+        self._sweeper = None
+        self._pending = set()
+        self.last_active = 0.0
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def open(self, local_ip):
+        """Bind the sockets, returns the (address, port) the client has to send to."""
+        loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ':' in local_ip else socket.AF_INET
+        self.client = await self._endpoint(loop, family, (local_ip, 0), self.from_client)
+        self.remotes[socket.AF_INET] = await self._endpoint(loop, socket.AF_INET, ('0.0.0.0', 0), self.from_remote)
+        if socket.has_ipv6:
+            try:
+                self.remotes[socket.AF_INET6] = await self._endpoint(
+                    loop, socket.AF_INET6, ('::', 0), self.from_remote)
+            except OSError as e:
+                logger.debug("No IPv6 UDP socket: %s", e)
+        self.last_active = loop.time()
+        return self.client.sock.getsockname()[:2]
+
+    @staticmethod
+    async def _endpoint(loop, family, address, handler):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            if family == socket.AF_INET6 and address[0] == '::':
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(address)
+            endpoint = _Endpoint(sock, handler)
+            await loop.create_datagram_endpoint(lambda: endpoint, sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+        return endpoint
+
+    def close(self):
+        for endpoint in (self.client, *self.remotes.values()):
+            if endpoint is not None and endpoint.transport is not None:
+                endpoint.transport.close()
+        self.remotes.clear()
+        self.nat.clear()
+        for task in self._pending:
+            task.cancel()
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def from_client(self, data, addr):
+        if addr != self.client_addr:
+            if self.client_addr is not None or addr[0] != self.client_ip or \
+                    (self.client_port and addr[1] != self.client_port):
+                self.dropped += 1
+                return
+            self.client_addr = addr
+
+        # Most datagrams go to a destination already seen: look up the raw header, no parsing.
+        sockaddr = None
+        if len(data) > 4:
+            if data[3] == ATYP_DOMAIN:
+                offset = 7 + data[4]
+                cached = self._domains.get(bytes(data[:offset]))
+                if cached is not None and cached[1] > asyncio.get_running_loop().time():
+                    sockaddr = cached[0]
+            else:
+                offset = 10 if data[3] == ATYP_IPV4 else 22
+                sockaddr = self._targets.get(bytes(data[:offset]))
+        if sockaddr is None:
+            try:
+                atyp, host, port, offset = parse_header(data)
+            except (ValueError, UnicodeDecodeError):
+                self.dropped += 1
+                return
+            if atyp == ATYP_DOMAIN:
+                task = asyncio.get_running_loop().create_task(
+                    self._send_resolved(bytes(data[:offset]), host, port, bytes(data[offset:])))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+                return
+            sockaddr = (host, port) if atyp == ATYP_IPV4 else (host, port, 0, 0)
+            if len(self._targets) < MAX_PEERS:
+                self._targets[bytes(data[:offset])] = sockaddr
+
+        self.send_remote(sockaddr, memoryview(data)[offset:])
+
+    async def _send_resolved(self, header, host, port, payload):
+        try:
+            addresses = await self.resolve(host)
+        except OSError as e:
+            logger.debug("UDP destination %s does not resolve: %s", host, e)
+            self.dropped += 1
+            return
+        address = addresses[0]
+        sockaddr = (address, port, 0, 0) if ':' in address else (address, port)
+        if self.dns_ttl > 0:
+            now = asyncio.get_running_loop().time()
+            if len(self._domains) >= MAX_PEERS:
+                self._domains = {k: v for k, v in self._domains.items() if v[1] > now}
+            if len(self._domains) < MAX_PEERS:
+                self._domains[header] = (sockaddr, now + self.dns_ttl)
+        self.send_remote(sockaddr, payload)
+
+    def send_remote(self, sockaddr, payload):
+        endpoint = self.remotes.get(socket.AF_INET6 if len(sockaddr) == 4 else socket.AF_INET)
+        entry = self.nat.get(sockaddr)
+        if entry is None:
+            if endpoint is None or len(self.nat) >= MAX_PEERS:
+                self.dropped += 1
+                return
+            entry = self.nat[sockaddr] = [0.0, encode_header(sockaddr[0], sockaddr[1])]
+            if self._sweeper is None:
+                self._sweeper = asyncio.get_running_loop().call_later(self.nat_timeout, self._sweep)
+        entry[0] = self.last_active = asyncio.get_running_loop().time()
+        endpoint.transport.sendto(payload, sockaddr)
+        self.sent += 1
+
+    def from_remote(self, data, addr):
+        entry = self.nat.get(addr)
+        if entry is None:
+            self.dropped += 1  # Not a peer the client talked to
+            return
+        entry[0] = self.last_active = asyncio.get_running_loop().time()
+        transport = self.client.transport
+        # Header and payload go out as one datagram without joining them into a new bytes object.
+        if not transport.get_write_buffer_size():
+            try:
+                self.client.sock.sendmsg((entry[1], data), (), 0, self.client_addr)
+                self.received += 1
+                return
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                logger.debug("UDP send to %s failed: %s", self.client_addr, e)
+                self.dropped += 1
+                return
+        transport.sendto(entry[1] + data, self.client_addr)
+        self.received += 1
+
+    def _sweep(self):
+        self._sweeper = None
+        deadline = asyncio.get_running_loop().time() - self.nat_timeout
+        for sockaddr in [sockaddr for sockaddr, entry in self.nat.items() if entry[0] < deadline]:
+            del self.nat[sockaddr]
+        if self.nat:
+            self._sweeper = asyncio.get_running_loop().call_later(self.nat_timeout / 2, self._sweep)
@@ -1,29 +1,166 @@
+import os
+import sys
+import json
+import queue
 import logging
 import logging.handlers
 import asyncio
+import weakref
+import daemon
+from daemon import pidfile
 
+import relay
+import workers
+import resolver
+import dialer
+import metrics
+import admission
 
-def setup_logging(filename, log_size, verbose):
+
+# 关闭时等待队列腾出空间放入结束标记的秒数
+STOP_TIMEOUT = 5.0
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """
+    stop()默认用put_nowait放入结束标记，有界队列满时抛出queue.Full（logging.shutdown()会再抛出）。
+    这里阻塞等待，超时（写入线程卡住）则丢弃队列中剩余的记录。
+    """
+
+    def enqueue_sentinel(self):
+        try:
+            self.queue.put(self._sentinel, timeout=STOP_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+        while True:
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                pass
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    把日志记录放入有界队列，由监听线程格式化并写入`handler`，事件循环线程不做任何磁盘I/O。
+    队列满时丢弃记录并计入dropped。
+    """
+
+    def __init__(self, handler, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = None
+        self._start_listener()
+        # fork后子进程中没有监听线程（守护进程、多工作进程），需要重新启动
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start_listener(self):
+        self.listener = _QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+
+    def _after_fork(self):
+        if self.listener is not None:
+            self.queue = queue.Queue(self.maxsize)
+            self._start_listener()
+
+    def prepare(self, record):
+        # 不在调用线程中格式化，消息和时间戳由监听线程生成
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # logging.shutdown()时先把队列中剩余的记录写完
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行JSON，访问日志的extra={'access': {...}}字段合并到顶层。"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'process': record.process,
+            'task': getattr(record, 'async_task_id', None),
+            'level': record.levelname,
+            'location': f"{record.filename}:{record.lineno}",
+            'message': record.getMessage(),
+        }
+        access = getattr(record, 'access', None)
+        if access:
+            entry.update(access)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """每`rate`条记录只保留一条。"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.count = 0
+
+    def filter(self, record):
+        self.count += 1
+        return self.count % self.rate == 1 % self.rate
+
+
+def setup_logging(filename, log_size, verbose, queue_size=0, fmt='text', access_sample=1):
     """
     设置日志记录，包括异步任务ID过滤器。
     :param filename: 日志文件名，'-'表示标准输出
     :param log_size: 日志文件最大大小（MB）
     :param verbose: 是否启用详细日志记录
+    :param queue_size: 大于0时通过有界队列异步写日志，队列满时丢弃
+    :param fmt: 'text'或'json'
+    :param access_sample: 访问日志（zzapp.access）每N条记录一条
     :return: 配置好的logger对象
     """
     class LoggingAsyncTaskIdFilter(logging.Filter):
+        def __init__(self):
+            super().__init__()
+            # 缓存上一个任务的名称：未命名任务每次get_name()都会重新格式化'Task-N'
+            self.task = None
+            self.name = 'Main'
+
         def filter(self, record):
             try:
-                record.async_task_id = asyncio.current_task().get_name()
+                task = asyncio.current_task()
             except RuntimeError:  # 当不在协程中时
+                task = None
+            if task is None:
+                # 事件循环回调（如信号处理）中没有当前任务
                 record.async_task_id = 'Main'
+                return True
+            if self.task is None or self.task() is not task:
+                self.task = weakref.ref(task)
+                self.name = task.get_name()
+            record.async_task_id = self.name
             return True
 
     logger = logging.getLogger("zzapp")
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
 
-    # 添加task_id过滤器
-    logger.addFilter(LoggingAsyncTaskIdFilter())
+    if access_sample > 1:
+        logging.getLogger("zzapp.access").addFilter(SampleFilter(access_sample))
 
     if not filename or filename in ('-', 'STDOUT'):
         handler = logging.StreamHandler()
@@ -31,10 +168,191 @@ def setup_logging(filename, log_size, verbose):
         handler = logging.handlers.RotatingFileHandler(
             filename, maxBytes=(log_size * (1 << 20)), backupCount=5)
 
-    formatter = logging.Formatter(
-        "%(asctime)s %(name)s[%(process)d][%(thread)d][%(async_task_id)s] [%(levelname)s] [%(filename)s:%(lineno)d]%(message)s"
-    )
+    if fmt == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s %(name)s[%(process)d][%(thread)d][%(async_task_id)s] [%(levelname)s] [%(filename)s:%(lineno)d]%(message)s"
+        )
     handler.setFormatter(formatter)
+
+    if queue_size > 0:
+        handler = QueueLogHandler(handler, queue_size)
+
+    # 添加task_id过滤器，放在handler上以便zzapp.access等子logger的记录也经过它，
+    # 且必须在事件循环线程中执行（QueueLogHandler的过滤器在入队前执行）。
+    # 格式中不含async_task_id时不添加，省去每条记录查找当前任务
+    if isinstance(formatter, JsonFormatter) or '%(async_task_id)' in formatter._fmt:
+        handler.addFilter(LoggingAsyncTaskIdFilter())
     logger.addHandler(handler)
 
     return logger
+
+
+def log_streams(logger):
+    """logger所有handler（含队列后面的handler）打开的流，守护进程需要保留它们。"""
+    streams = []
+    for handler in logger.handlers:
+        handler = getattr(handler, 'handler', handler)
+        stream = getattr(handler, 'stream', None)
+        if stream is not None:
+            streams.append(stream)
+    return streams
+
+
+def log_stats():
+    dropped = 0
+    for handler in logging.getLogger("zzapp").handlers:
+        dropped += getattr(handler, 'dropped', 0)
+    return {'dropped': dropped}
+
+
+def add_proxy_arguments(parser):
+    """
+    添加socks5.py与httproxy.py共用的命令行参数（转发、DNS、上游连接、准入控制、多进程、日志、守护进程）。
+    :param parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--relay', type=str, dest="relay", default='auto', choices=relay.ENGINES,
+                        help="Tunnel relay engine [default: auto]")
+    parser.add_argument('--dns-ttl', type=float, dest="dns_ttl", default=60.0,
+                        help="Seconds a resolved name is cached [default: 60]")
+    parser.add_argument('--dns-negative-ttl', type=float, dest="dns_negative_ttl", default=10.0,
+                        help="Seconds a failed lookup is cached [default: 10]")
+    parser.add_argument('--dns-cache-size', type=int, dest="dns_cache_size", default=4096,
+                        help="Maximum number of cached names [default: 4096]")
+    parser.add_argument('--prefer', type=str, dest="prefer", default='any', choices=resolver.PREFERENCES,
+                        help="Address family tried first for domain targets [default: any]")
+    parser.add_argument('--connect-timeout', type=float, dest="connect_timeout", default=10.0,
+                        help="Deadline for connecting to an upstream target [default: 10]")
+    parser.add_argument('--attempt-delay', type=float, dest="attempt_delay", default=0.25,
+                        help="Happy Eyeballs delay between connection attempts [default: 0.25]")
+    parser.add_argument('--failure-ttl', type=float, dest="failure_ttl", default=30.0,
+                        help="Seconds a failed upstream address:port is tried last [default: 30]")
+    parser.add_argument('--max-connections', type=int, dest="max_connections", default=0,
+                        help="Maximum open client connections per process, 0 for no limit [default: 0]")
+    parser.add_argument('--max-per-ip', type=int, dest="max_per_ip", default=0,
+                        help="Maximum open client connections per source IP, 0 for no limit [default: 0]")
+    parser.add_argument('--ip-rate', type=float, dest="ip_rate", default=0.0,
+                        help="New connections per second allowed per source IP, 0 for no limit [default: 0]")
+    parser.add_argument('--ip-burst', type=int, dest="ip_burst", default=0,
+                        help="Connection burst allowed per source IP above --ip-rate [default: --ip-rate]")
+    parser.add_argument('--handshake-timeout', type=float, dest="handshake_timeout", default=10.0,
+                        help="Seconds a client has to send its SOCKS5 request or HTTP request header, "
+                             "0 to wait forever [default: 10]")
+    parser.add_argument('--auth-timeout', type=float, dest="auth_timeout", default=10.0,
+                        help="Seconds a client has to complete authentication, 0 to wait forever [default: 10]")
+    parser.add_argument('--idle-timeout', type=float, dest="idle_timeout", default=0.0,
+                        help="Close tunnels with no traffic in either direction for this many seconds, "
+                             "0 to keep them [default: 0]")
+    parser.add_argument('--bandwidth', type=int, dest="bandwidth", default=0,
+                        help="Bytes per second per tunnel and direction, 0 for no limit [default: 0]")
+    parser.add_argument('--metrics-port', type=int, dest="metrics_port", default=None,
+                        help="Serve Prometheus metrics on this port, worker N uses port+N [default: disabled]")
+    parser.add_argument('--metrics-host', type=str, dest="metrics_host", default='127.0.0.1',
+                        help="Host the metrics listener binds to [default: 127.0.0.1]")
+    parser.add_argument('-w', '--workers', type=int, dest="workers", default=1,
+                        help="Number of SO_REUSEPORT worker processes [default: 1]")
+    parser.add_argument('--drain-timeout', type=float, dest="drain_timeout", default=30.0,
+                        help="Seconds a worker waits for open connections on SIGTERM/SIGHUP [default: 30]")
+    parser.add_argument('-l', '--logfile', type=str, dest="logfile", default='STDOUT',
+                        help="Path to the logfile [default: STDOUT]")
+    parser.add_argument('--log-queue', type=int, dest="log_queue", default=0,
+                        help="Write logs from a background thread through a queue of this size, "
+                             "dropping records when it is full [default: 0, synchronous]")
+    parser.add_argument('--log-format', type=str, dest="log_format", default='text', choices=('text', 'json'),
+                        help="Log line format [default: text]")
+    parser.add_argument('--access-log-sample', type=int, dest="access_log_sample", default=1,
+                        help="Log one of every N access lines (CONNECTs, requests) [default: 1]")
+    parser.add_argument('-d', '--daemon', action='store_true', dest="daemon", default=False,
+                        help="Daemonize (run in the background). Daemon mode must specify logfile")
+    parser.add_argument('-v', '--verbose', action='store_true', dest="verbose", default=False,
+                        help="Log debug info")
+
+
+def check_proxy_arguments(parser, args):
+    """
+    校验add_proxy_arguments添加的参数，出错时通过parser.error退出。
+    """
+    if args.daemon and args.logfile in ('-', 'STDOUT'):
+        parser.error("Daemon mode requires a logfile path.")
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+
+    if args.workers > 1 and not workers.HAS_REUSEPORT:
+        parser.error("--workers requires SO_REUSEPORT support.")
+
+    if args.log_queue < 0 or args.access_log_sample < 1:
+        parser.error("--log-queue must be >= 0 and --access-log-sample >= 1.")
+
+    if min(args.max_connections, args.max_per_ip, args.ip_rate, args.ip_burst, args.handshake_timeout,
+           args.auth_timeout, args.idle_timeout, args.bandwidth) < 0:
+        parser.error("Admission control limits must be >= 0.")
+
+    if args.metrics_port is not None and not (0 < args.metrics_port + args.workers - 1 < 65536):
+        parser.error("--metrics-port invalid.")
+
+
+def serve(args, make_proxy):
+    """
+    创建代理并运行，--workers大于1时由Supervisor管理多个工作进程。
+    :param make_proxy: make_proxy(dns, upstream, metrics, limits)，返回带start()/drain()的代理对象
+    """
+    dns = resolver.Resolver(args.dns_ttl, args.dns_negative_ttl, args.dns_cache_size, args.prefer)
+    upstream = dialer.Dialer(args.connect_timeout, args.attempt_delay, args.failure_ttl)
+    proxy_metrics = None
+    if args.metrics_port is not None:
+        proxy_metrics = metrics.ProxyMetrics(args.metrics_host, args.metrics_port)
+    # 多进程时每个工作进程各自计数，连接数限制按进程生效
+    limits = admission.Admission(args.max_connections, args.max_per_ip, args.ip_rate, args.ip_burst,
+                                 args.handshake_timeout, args.auth_timeout, args.idle_timeout, args.bandwidth)
+    proxy = make_proxy(dns, upstream, proxy_metrics, limits)
+
+    def run_worker(slot):
+        # 每个工作进程使用独立的指标端口
+        if proxy_metrics:
+            proxy_metrics.port += slot
+        asyncio.run(workers.serve_worker(proxy, args.drain_timeout))
+
+    if args.workers > 1:
+        supervisor = workers.Supervisor(args.workers, run_worker)
+        supervisor.run()
+    else:
+        asyncio.run(proxy.start())
+
+
+def run_main(args, make_proxy):
+    """
+    初始化日志，前台运行或以守护进程方式运行serve()。
+    """
+    if not (0 < args.port < 65536):
+        print(f'Port[{args.port}] invalid', file=sys.stderr)
+        sys.exit(1)
+
+    logger = setup_logging(args.logfile, 20, args.verbose, args.log_queue, args.log_format, args.access_log_sample)
+
+    if args.daemon:
+        streams = log_streams(logger)
+        context = daemon.DaemonContext(
+            working_directory='/tmp',
+            umask=0o022,
+            pidfile=pidfile.TimeoutPIDLockFile(args.pidfile),
+            files_preserve=[stream.fileno() for stream in streams],
+            stdout=streams[0],
+            stderr=streams[0],
+        )
+        try:
+            with context:
+                logger.info("Daemon process started.")
+                serve(args, make_proxy)
+        except Exception as e:
+            logger.critical("Daemon failed to start: %s", e)
+            sys.exit(1)
+    else:
+        try:
+            logger.info("Starting proxy in foreground.")
+            serve(args, make_proxy)
+        except KeyboardInterrupt:
+            logger.info("Proxy stopped by user.")
+        except Exception as e:
+            logger.error("An unexpected error occurred: %s", e, exc_info=True)
@@ -0,0 +1,152 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import logging
+
+logger = logging.getLogger('zzapp')
+
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+# A worker that dies sooner than this after being spawned is crash looping,
+# its replacement is delayed by RESPAWN_DELAY seconds.
+MIN_UPTIME = 1.0
+RESPAWN_DELAY = 1.0
+
+
+class Supervisor:
+    """
+    Pre-fork supervisor.
+    Every worker calls `target(slot)` in its own process, which is expected to bind the
+    listening socket with SO_REUSEPORT so the kernel spreads connections between them.
+    `slot` is 0..workers-1 and is kept when a worker is restarted or replaced.
+
+    SIGTERM/SIGINT: forwarded to the workers, which drain and exit.
+    SIGHUP: a fresh set of workers is started and the old ones are told to drain.
+    """
+
+    def __init__(self, workers, target):
+        self.workers = workers
+        self.target = target
+        self.children = {}  # pid -> (slot, spawn time)
+        self.retiring = set()
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+            slot, started = child
+            code = os.waitstatus_to_exitcode(status)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info("Worker %s exited after drain (%s).", pid, code)
+                continue
+            if self.stopping:
+                logger.info("Worker %s exited (%s).", pid, code)
+                continue
+
+            logger.error("Worker %s died unexpectedly (%s), restarting.", pid, code)
+            if time.monotonic() - started < MIN_UPTIME:
+                time.sleep(RESPAWN_DELAY)
+            if not self.stopping:
+                self.spawn(slot)
+
+        logger.info("All workers exited.")
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                # Ctrl+C hits the whole process group, the supervisor turns it into a drain.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.target(slot)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                logger.critical("Worker failed: %s", e, exc_info=True)
+                code = 1
+            finally:
+                # os._exit: the worker must not run the parent's atexit hooks (e.g. pidfile release),
+                # nor return into the supervisor loop, even when flushing the logs fails.
+                try:
+                    logging.shutdown()
+                finally:
+                    os._exit(code)
+
+        self.children[pid] = (slot, time.monotonic())
+        logger.info("Started worker %s (slot %s).", pid, slot)
+        return pid
+
+    def _on_stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Received signal %s, stopping workers.", signum)
+        self._signal_children(signal.SIGTERM)
+
+    def _on_reload(self, signum, frame):
+        if self.stopping:
+            return
+        logger.info("Received SIGHUP, replacing workers.")
+        old = [pid for pid in self.children if pid not in self.retiring]
+        for slot in range(self.workers):
+            self.spawn(slot)
+        for pid in old:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def _signal_children(self, signum):
+        for pid in list(self.children):
+            self._kill(pid, signum)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+async def serve_worker(proxy, drain_timeout):
+    """
+    Worker body: serve on a SO_REUSEPORT socket until SIGTERM/SIGHUP, then drain.
+    `proxy` needs start(reuse_port=...) and drain(timeout).
+    """
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+
+    server_task = asyncio.create_task(proxy.start(reuse_port=True), name="server")
+    await asyncio.wait([stop, server_task], return_when=asyncio.FIRST_COMPLETED)
+    if server_task.done():
+        # Failed to bind or serve, let the supervisor see it as a crash.
+        server_task.result()
+        return
+
+    logger.info("Worker %s draining.", os.getpid())
+    await proxy.drain(drain_timeout)
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
+